@@ -38,6 +38,19 @@ options:
         required: false
         default: present
         choices: [ 'present', 'reboot' ]
+    wait:
+        required: false
+        default: false
+        choices: [ true, false ]
+        description:
+            - With state=reboot, wait until the switch has come back and
+              its CLI prompt answers. Downtime and time to ready are
+              returned in 'reboot'
+    wait_timeout:
+        required: false
+        default: 600
+        description:
+            - How long to wait for the switch to come back after a reboot
     host:
         required: true
         default: empty
@@ -58,6 +71,69 @@ options:
         default: 30
         description:
             - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    channels:
+        required: false
+        default: 1
+        description:
+            - Number of shells opened on the SSH connection to run the
+              display commands of fact gathering concurrently. Falls back
+              to fewer if the switch refuses more sessions
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. With state=present a valid snapshot is returned
+              instead of reading the switch again. 0 disables the snapshot
 '''
 
 EXAMPLES = '''
@@ -81,19 +157,32 @@ EXAMPLES = '''
   - name: gather facts from switch
     comware_5_2: host=192.168.1.100 username=admin password=ckrit
 
+# reboot and wait until the switch is back
+- hosts: localhost
+  tasks:
+  - name: reboot switch
+    comware_5_2: host=192.168.1.100 username=admin password=ckrit state=reboot wait=true
+
 '''
 
 # http://code.patg.net/comware_5_2.tar.gz
-from comware_5_2 import Comware_5_2
+from comware_5_2 import Comware_5_2, cached_facts, facts_to_dict, client_kwargs
 from ansible.module_utils.basic import *
 
 
 class Comware_5_2_Facts(Comware_5_2):
     def dispatch(self):
-        facts = self.get_facts()
-        state = self.module.params.get('state')
-        if state == 'reboot':
+        state = self.params.get('state')
+        if state == 'reboot' and self.get_check_mode():
+            # no session for a reboot that won't happen, facts only if
+            # a snapshot has them
             self.reboot()
+            return self._load_cached_facts() or {}
+        facts = self.get_facts(cached=state == 'present')
+        if state == 'reboot':
+            self.reboot(wait=self.params.get('wait'),
+                        wait_timeout=self.params.get('wait_timeout'),
+                        save=self.params.get('save'))
         return facts
 
 
@@ -103,12 +192,24 @@ def main():
             developer_mode=dict(type='bool'),
             state=dict(required=False, default='present',
                        choices=['present', 'reboot']),
+            wait=dict(required=False, type='bool', default=False),
+            wait_timeout=dict(default=600, type='int'),
             save=dict(required=False, type='bool', default=False),
             username=dict(required=True),
             password=dict(required=False),
             host=dict(required=True),
             gather_facts=dict(required=False, type='bool', default='True'),
             timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            channels=dict(default=1, type='int'),
             port=dict(default=22, type='int'),
             private_key_file=dict(required=False)
         ),
@@ -125,14 +226,22 @@ def main():
                          changed=False,
                          msg=err_msg,
                          ansible_facts={})
+
+    # a recent snapshot answers without opening a session
+    if module.params.get('state') == 'present':
+        facts = cached_facts(module.params.get('host'),
+                             module.params.get('facts_cache_ttl'))
+        if facts is not None:
+            if not module.params.get('gather_facts'):
+                facts = {}
+            module.exit_json(failed=failed,
+                             changed=False,
+                             msg="",
+                             reboot={},
+                             ansible_facts=facts)
+
     switch = Comware_5_2_Facts(module,
-                               host=module.params.get('host'),
-                               username=module.params.get('username'),
-                               password=module.params.get('password'),
-                               timeout=module.params.get('timeout'),
-                               port=module.params.get('port'),
-                               private_key_file=
-                               module.params.get('private_key_file'))
+                               **client_kwargs(module.params))
 
     try:
         facts = switch.dispatch()
@@ -142,7 +251,8 @@ def main():
         module.exit_json(failed=failed,
                          changed=switch.get_changed(),
                          msg=switch.get_message(),
-                         ansible_facts=facts)
+                         reboot=switch.get_reboot_stats(),
+                         ansible_facts=facts_to_dict(facts))
     except Exception, e:
         msg = switch.get_message() + " %s %s" % (e.__class__, e)
         switch.fail(msg)
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+
+# (c) 2014, Patrick Galbraith <patg@patg.net>
+#
+# This file is part of Ansible
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: comware_5_2_batch
+version_added: 0.1
+author: Patrick Galbraith
+short_description: Run several operations on Comware 5.2-based Switches
+requirements: [ paramiko comware_5_2 (http://code.patg.net/comware_5_2.tar.gz)]
+description:
+    - Runs an ordered list of vlan, port, user, user_interface and
+      hostname operations over one session. Facts are read once before
+      the operations and once after them to verify all changes, and the
+      configuration is saved at most once. Before an operation on a
+      VLAN, port, user or user-interface an earlier operation changed,
+      the facts are read again and the changes so far verified
+options:
+    tasks:
+        required: true
+        description:
+            - List of operations. Each has op, one of vlan, port, user,
+              user_interface or hostname, and the options of the
+              comware_5_2_vlan, comware_5_2_port, comware_5_2_user,
+              comware_5_2_user_int or comware_5_2_hostname module
+    save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, all changes will be written, once all operations
+              are done. The write is skipped when nothing was changed and
+              the running configuration already matches the saved
+              configuration
+    defer_save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true together with save, the write is left to a
+              comware_5_2_save handler so a play saves each switch once.
+              The changes of this task are recorded as pending
+    gather_facts:
+        required: false
+        default: true
+        choices: [ true, false ]
+        description:
+            - Whether to return the switch facts
+    startup_cfg:
+        required: false
+        default: startup.cfg
+        description:
+            - The name of the save startup config file when save or reboot
+    host:
+        required: true
+        default: empty
+        description:
+            - host/ip of switch
+    username:
+        required: true
+        default: empty
+        description:
+            - username to connect to switch as
+    password:
+        required: true
+        default: empty
+        description:
+            - password to connect switch with
+    timeout:
+        required: false
+        default: 30
+        description:
+            - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    send_window_max:
+        required: false
+        default: 8
+        description:
+            - Maximum number of configuration commands sent before their
+              echo is received. The window adapts to the measured echo
+              latency, set to 1 to send one command per round trip
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. Check mode uses a valid snapshot instead of reading
+              the switch again. 0 disables the snapshot
+'''
+
+EXAMPLES = '''
+
+# file: switch_access.yml
+- hosts: switches
+  tasks:
+  - name: provision access switch
+    local_action:
+      module: comware_5_2_batch
+      host: "{{ inventory_hostname }}"
+      username: admin
+      password: ckrit
+      save: true
+      tasks:
+      - op: hostname
+        hostname: "{{ inventory_hostname_short }}"
+      - op: vlan
+        vlan_id: 11
+        vlan_name: users
+      - op: port
+        name: GigabitEthernet1/0/1
+        link_type: access
+        vlans: [ 11 ]
+      - op: port
+        name: GigabitEthernet1/0/24
+        link_type: trunk
+        vlans: [ 11, 20-30 ]
+      - op: user
+        user_name: jimbob
+        user_pass: seekrit
+        auth_level: level 3
+        services: [ ssh ]
+      - op: user_interface
+        user_interface_type: vty
+        user_interface_id: [ 0, 1, 2, 3, 4 ]
+        authentication_mode: scheme
+        in_protocol: ssh
+
+'''
+
+# http://code.patg.net/comware_5_2.tar.gz
+from comware_5_2 import Comware_5_2_Batch, client_kwargs
+from ansible.module_utils.basic import *
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            developer_mode=dict(type='bool'),
+            gather_facts=dict(required=False, type='bool', default=True),
+            save=dict(type='bool', default=False),
+            defer_save=dict(type='bool', default=False),
+            startup_cfg=dict(),
+            username=dict(required=True),
+            password=dict(required=True),
+            host=dict(required=True),
+            tasks=dict(required=True, type='list'),
+            timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            send_window_max=dict(default=8, type='int'),
+            port=dict(default=22, type='int'),
+            private_key_file=dict(required=False)
+        ),
+        supports_check_mode=True,
+    )
+
+    failed = False
+
+    switch = Comware_5_2_Batch(module,
+                               **client_kwargs(module.params))
+
+    try:
+        result = switch.run(module.params)
+
+        module.exit_json(failed=failed,
+                         changed=result['changed'],
+                         msg=result['msg'],
+                         commands=result['commands'],
+                         diff=result['diff'],
+                         ansible_facts=result['facts'])
+    except Exception, e:
+        msg = switch.get_message() + "%s %s" % (e.__class__, e)
+        switch.fail(msg)
+
+# entry point
+main()
@@ -41,6 +41,16 @@ options:
         choices: [ false, true ]
         description:
             - if true, all changes will be written. Upon reboot, save
+            - The write is skipped when nothing was changed and the running
+              configuration already matches the saved configuration
+    defer_save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true together with save, the write is left to a
+              comware_5_2_save handler so a play saves each switch once.
+              The changes of this task are recorded as pending
     startup_cfg:
         required: false
         default: startup.cfg
@@ -63,14 +73,84 @@ options:
             - password to connect switch with
     timeout:
         required: false
-        default: 5
+        default: 30
         description:
             - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    send_window_max:
+        required: false
+        default: 8
+        description:
+            - Maximum number of configuration commands sent before their
+              echo is received. The window adapts to the measured echo
+              latency, set to 1 to send one command per round trip
     hostname:
         required: true
         default: Must be set to valid hostname
         description:
             - hostname
+    gather_facts:
+        required: false
+        default: true
+        choices: [ true, false ]
+        description:
+            - Whether to return the switch facts. When false only the
+              sysname line of the configuration is read and checked
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. Check mode uses a valid snapshot instead of reading
+              the switch again. 0 disables the snapshot
 '''
 
 EXAMPLES = '''
@@ -97,88 +177,33 @@ OR
 '''
 
 # http://code.patg.net/comware_5_2.tar.gz
-from comware_5_2 import Comware_5_2
+from comware_5_2 import Comware_5_2_Hostname, client_kwargs
 from ansible.module_utils.basic import *
 
 
-class Comware_5_2_Hostname(Comware_5_2):
-    def dispatch(self):
-        facts = self._handle_hostname()
-        return facts
-
-    def _handle_hostname(self):
-        facts = self.get_facts()
-        hostname = self.module.params.get('hostname')
-        if facts['current_config']['sysname'] != hostname:
-            facts = self._set_hostname(facts, hostname)
-        else:
-             self.append_message("The hostname %s was already set.\n" % hostname)
-        # After adding or deleting vlan, save
-        if self.module.params.get('save') is True:
-            self.save()
-
-        return facts
-
-#    def _user_exists(self, facts, name):
-#        return name in facts['current_config']['local-user']
-#
-#    def _user_changed(self, facts, user):
-#        current_user = facts['current_config']['local-user']
-#        return current_user['service-type'] == user['services']
-
-    def _set_hostname(self, facts, hostname):
-        #self.dev_setup()
-        self.set_changed(False)
-
-        self._exec_command("sysname %s\n" % hostname,
-                           "ERROR: unable to enter local user view")
-        # leave interface view
-#        self._quit()
-        # refresh facts
-        facts = self.get_facts()
-        # TODO:
-        if hostname == facts['current_config']['sysname']:
-            self.set_changed(True)
-            self.append_message("The hostname %s has been updated.\n" %
-                                hostname)
-        else:
-            self.append_message("Unable to update the hostname %s.\n" %
-                                hostname)
-
-        return facts
-
-#    def _delete_user(self, facts, name):
-#        self.set_changed(False)
-#        if not self._user_exists(facts, name):
-#            self.fail("The user %s does not exist." % name)
-#
-#        self._send_command("undo local-user %s\n" % name,
-#                           "Unable to delete user %s" % name)
-#
-#        # refresh facts
-#        facts = self.get_facts()
-#
-#        if name not in facts['current_config']['local-user']:
-#            self.set_changed(True)
-#            self.append_message("User %s deleted\n" % name)
-#        else:
-#            self.append_message("Unable to delete user %s\n" % name)
-#
-#        return facts
-#
-#
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             developer_mode=dict(type='bool'),
             gather_facts=dict(required=False, type='bool', default=True),
             save=dict(type='bool', default=False),
+            defer_save=dict(type='bool', default=False),
             startup_cfg=dict(),
             username=dict(required=True),
             password=dict(required=True),
             host=dict(required=True),
             hostname=dict(required=True),
             timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            send_window_max=dict(default=8, type='int'),
             port=dict(default=22, type='int'),
             private_key_file=dict(required=False)
         ),
@@ -187,23 +212,17 @@ def main():
     failed = False
 
     switch = Comware_5_2_Hostname(module,
-                              host=module.params.get('host'),
-                              username=module.params.get('username'),
-                              password=module.params.get('password'),
-                              timeout=module.params.get('timeout'),
-                              port=module.params.get('port'),
-                              private_key_file=
-                              module.params.get('private_key_file'))
+                                  **client_kwargs(module.params))
 
     try:
-        facts = switch.dispatch()
-        if not module.params.get('gather_facts'):
-            facts = {}
+        result = switch.run(module.params)
 
         module.exit_json(failed=failed,
-                         changed=switch.get_changed(),
-                         msg=switch.get_message(),
-                         ansible_facts=facts)
+                         changed=result['changed'],
+                         msg=result['msg'],
+                         commands=result['commands'],
+                         diff=result['diff'],
+                         ansible_facts=result['facts'])
     except Exception, e:
         msg = switch.get_message() + "%s %s" % (e.__class__, e)
         switch.fail(msg)
@@ -41,6 +41,16 @@ options:
         choices: [ false, true ]
         description:
             - if true, all changes will be written. Upon reboot, save
+            - The write is skipped when nothing was changed and the running
+              configuration already matches the saved configuration
+    defer_save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true together with save, the write is left to a
+              comware_5_2_save handler so a play saves each switch once.
+              The changes of this task are recorded as pending
     state:
         required: false
         choices: [ enabled, shutdown]
@@ -69,9 +79,72 @@ options:
             - password to connect switch with
     timeout:
         required: false
-        default: 5
+        default: 30
         description:
             - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    send_window_max:
+        required: false
+        default: 8
+        description:
+            - Maximum number of configuration commands sent before their
+              echo is received. The window adapts to the measured echo
+              latency, set to 1 to send one command per round trip
+    gather_facts:
+        required: false
+        default: true
+        choices: [ true, false ]
+        description:
+            - Whether to return the switch facts. When false only the
+              interface sections of the configuration are parsed
     name:
         required: true
         default: Must be set to valid port name
@@ -82,7 +155,9 @@ options:
         required: true
         default: Must be a valid numeric ID
         description:
-            - List of vlan IDs
+            - List of vlan IDs. Ranges such as 10-20 may be given.
+              A trunk or hybrid port keeps the VLANs it already has, the
+              port is left unchanged when it already carries these
 
     link_type:
         required: false
@@ -92,6 +167,13 @@ options:
             - Port link type
 
 
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. Check mode uses a valid snapshot instead of reading
+              the switch again. 0 disables the snapshot
 '''
 
 EXAMPLES = '''
@@ -121,103 +203,17 @@ OR
 '''
 
 # http://code.patg.net/comware_5_2.tar.gz
-from comware_5_2 import Comware_5_2
+from comware_5_2 import Comware_5_2_Port, client_kwargs
 from ansible.module_utils.basic import *
 
 
-class Comware_5_2_Port(Comware_5_2):
-    def dispatch(self):
-        facts = self._handle_port()
-        return facts
-
-    def _handle_port(self):
-        facts = self.get_facts()
-        port = {'name': self.module.params.get('name'),
-                'vlans': self.module.params.get('vlans'),
-                'link_type': self.module.params.get('link_type'),
-                'tagged': self.module.params.get('tagged'),
-                'state': self.module.params.get('state')}
-        if port['name'] not in facts['current_config']['interfaces']:
-            self.fail("ERROR: the port name specified doesn't exist\
-                      or is invalid!")
-
-        if self._port_changed(facts, port):
-            facts = self._save_port(facts, port)
-        if self.module.params.get('save') is True:
-            self.save()
-
-        return facts
-
-    def _port_changed(self, facts, port):
-        tagged = 'tagged'
-        if port['tagged'] is False:
-            tagged = "un" + tagged
-
-        # TODO: solve this
-        # current_port = facts['current_config']['interfaces'][port['name']]
-        # TODO: 'port link_type' needs to be 'link-type'
-        #if port['port link-type'] != current_port['link_type']:
-        #    return True
-        #if port['vlans'] != current_port['vlan'][tagged][port['link_type']]:
-        #    return True
-
-        return True
-
-    def _save_port(self, facts, port):
-        # if something has changed, best to delete then recreate
-        self.set_changed(False)
-        # could use else, but this is self-documenting
-        tagged = 'tagged'
-        if not port['tagged']:
-            tagged = 'un' + tagged
-
-        if port['link_type'] == 'access' and port['tagged']:
-            self.fail("A link-type of 'access' cannot be tagged")
-        if port['link_type'] == 'access' and len(port['vlans']) > 1:
-            self.fail("A link-type of 'access' can only specify one vlan")
-
-        #current_link_type = \
-        # facts['current_config']['interfaces'][port['name']]['link_type']
-
-        self._send_command("interface %s\n" % port['name'],
-                           "ERROR: unable to enter interface view")
-        #if current_link_type != port['link_type'] and \
-        #        port['link_type'] != 'access':
-        if True:
-            self._send_command("port link-type acccess\n",
-                               "ERROR: unable to set link type to access")
-        type_err = "ERROR: unable to set link-type %s" % port['link_type']
-        self._send_command("port link-type %s\n" % port['link_type'], type_err)
-
-        vlan_list = " ".join(port['vlans'])
-        type_err = "Error: unable to set vlan %s access on port" % vlan_list
-        if port['link_type'] == 'hybrid':
-            self._send_command("port hybrid vlan %s %s\n" %
-                               (vlan_list, tagged), type_err)
-        elif port['link_type'] == 'trunk':
-            self._send_command("port trunk permit vlan %s\n" % vlan_list,
-                               type_err)
-        # access
-        else:
-            self._send_command("port access vlan %s\n" % vlan_list, type_err)
-
-        # leave interface view
-        self._quit()
-
-        # refresh facts
-        facts = self.get_facts()
-        self.set_changed(True)
-        self.append_message("PORT %s saved\n" % port['name'])
-
-        return facts
-
-
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             developer_mode=dict(type='bool'),
             gather_facts=dict(required=False, type='bool', default=True),
             save=dict(type='bool', default=False),
+            defer_save=dict(type='bool', default=False),
             startup_cfg=dict(),
             username=dict(required=True),
             password=dict(required=True),
@@ -231,6 +227,16 @@ def main():
             state=dict(required=False, default='present',
                        choices=['present', 'shutdown']),
             timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            send_window_max=dict(default=8, type='int'),
             port=dict(default=22, type='int'),
             private_key_file=dict(required=False)
         ),
@@ -240,23 +246,17 @@ def main():
     failed = False
 
     switch = Comware_5_2_Port(module,
-                              host=module.params.get('host'),
-                              username=module.params.get('username'),
-                              password=module.params.get('password'),
-                              timeout=module.params.get('timeout'),
-                              port=module.params.get('port'),
-                              private_key_file=
-                              module.params.get('private_key_file'))
+                              **client_kwargs(module.params))
 
     try:
-        facts = switch.dispatch()
-        if not module.params.get('gather_facts'):
-            facts = {}
+        result = switch.run(module.params)
 
         module.exit_json(failed=failed,
-                         changed=switch.get_changed(),
-                         msg=switch.get_message(),
-                         ansible_facts=facts)
+                         changed=result['changed'],
+                         msg=result['msg'],
+                         commands=result['commands'],
+                         diff=result['diff'],
+                         ansible_facts=result['facts'])
     except Exception, e:
         msg = switch.get_message() + "%s %s" % (e.__class__, e)
         module.fail_json(msg=msg)
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+
+# (c) 2014, Patrick Galbraith <patg@patg.net>
+#
+# This file is part of Ansible
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: comware_5_2_preflight
+version_added: 0.1
+author: Patrick Galbraith
+short_description: Check which Comware 5.2-based Switches answer on SSH
+requirements: [ comware_5_2 (http://code.patg.net/comware_5_2.tar.gz)]
+description:
+    - Connects to the SSH port of a list of switches, all at once, and
+      reads their SSH banner. No session is opened, so a fleet is
+      checked in about timeout seconds. Switches that don't answer with
+      a banner are returned apart, and can be marked so the other
+      comware_5_2 modules skip them after a quick probe instead of
+      spending their connect timeout on them.
+options:
+    hosts:
+        required: true
+        description:
+            - List of host/ip of the switches to check
+    port:
+        required: false
+        default: 22
+        description:
+            - SSH port of the switches
+    timeout:
+        required: false
+        default: 5
+        description:
+            - How long to wait for a switch to accept the connection and
+              send its banner
+    concurrency:
+        required: false
+        default: 500
+        description:
+            - How many switches are checked at the same time, at most
+              500
+    mark:
+        required: false
+        default: true
+        choices: [ true, false ]
+        description:
+            - if true, switches without a banner are marked as if they
+              had failed breaker_threshold connects in a row
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - The breaker_threshold of the modules run after this one
+'''
+
+EXAMPLES = '''
+
+# file: switches.yml
+- hosts: localhost
+  tasks:
+  - name: check which switches answer
+    comware_5_2_preflight:
+      hosts: "{{ groups['switches'] }}"
+    register: preflight
+
+- hosts: switches
+  tasks:
+  - name: gather facts of the switches that answered
+    local_action:
+      module: comware_5_2
+      host: "{{ inventory_hostname }}"
+      username: admin
+      password: ckrit
+    when: inventory_hostname in hostvars['localhost'].preflight.reachable
+
+'''
+
+# http://code.patg.net/comware_5_2.tar.gz
+from comware_5_2 import preflight, mark_unreachable
+from ansible.module_utils.basic import *
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            hosts=dict(required=True, type='list'),
+            port=dict(default=22, type='int'),
+            timeout=dict(default=5, type='int'),
+            concurrency=dict(default=500, type='int'),
+            mark=dict(type='bool', default=True),
+            breaker_threshold=dict(default=3, type='int')
+        ),
+        supports_check_mode=True,
+    )
+
+    hosts = module.params.get('hosts')
+    banners = preflight(hosts,
+                        port=module.params.get('port'),
+                        timeout=module.params.get('timeout'),
+                        concurrency=module.params.get('concurrency'))
+    reachable = [host for host in hosts if banners[host]]
+    not_ssh = [host for host in hosts if banners[host] == '']
+    unreachable = [host for host in hosts if banners[host] is None]
+
+    if module.params.get('mark') and not module.check_mode:
+        for host in not_ssh + unreachable:
+            mark_unreachable(host, module.params.get('breaker_threshold'))
+
+    module.exit_json(failed=False,
+                     changed=False,
+                     msg="%d reachable, %d not SSH, %d unreachable" %
+                     (len(reachable), len(not_ssh), len(unreachable)),
+                     reachable=reachable,
+                     not_ssh=not_ssh,
+                     unreachable=unreachable,
+                     banners=banners)
+
+# entry point
+main()
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+
+# (c) 2014, Patrick Galbraith <patg@patg.net>
+#
+# This file is part of Ansible
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: comware_5_2_rolling_reboot
+version_added: 0.1
+author: Patrick Galbraith
+short_description: Reboot Comware 5.2-based Switches in waves
+requirements: [ paramiko comware_5_2 (http://code.patg.net/comware_5_2.tar.gz)]
+description:
+    - Reboots a list of Comware 5.2-based Switches, max_in_flight at a
+      time. Every switch of a wave has to come back with its CLI prompt
+      and the expected VLANs before the next wave starts.
+options:
+    hosts:
+        required: true
+        description:
+            - List of host/ip of the switches to reboot, in order. A
+              switch listed more than once is rebooted once
+    max_in_flight:
+        required: false
+        default: 1
+        description:
+            - How many switches are rebooted at the same time
+    max_failures:
+        required: false
+        default: 0
+        description:
+            - Abort when more switches than this have failed. Switches of
+              the remaining waves are not rebooted
+    expected_vlans:
+        required: false
+        default: []
+        description:
+            - VLAN IDs that must be present after the reboot for a switch
+              to pass the health gate
+    save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - Whether to answer yes when the switch asks to save the
+              current configuration before rebooting
+    username:
+        required: true
+        default: empty
+        description:
+            - username to connect to the switches as
+    password:
+        required: true
+        default: empty
+        description:
+            - password to connect the switches with
+    timeout:
+        required: false
+        default: 30
+        description:
+            - How long to wait for a switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds each switch may take, every wait is cut short
+              to end by then. 0 leaves it unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    wait_timeout:
+        required: false
+        default: 600
+        description:
+            - How long to wait for a switch to come back after its reboot
+'''
+
+EXAMPLES = '''
+
+# file: firmware.yml
+- hosts: localhost
+  tasks:
+  - name: reboot access switches, ten at a time
+    local_action:
+      module: comware_5_2_rolling_reboot
+      username: admin
+      password: ckrit
+      max_in_flight: 10
+      max_failures: 2
+      expected_vlans: [ 1, 11 ]
+      hosts:
+      - 192.168.1.100
+      - 192.168.1.101
+      - 192.168.1.102
+
+'''
+
+import threading
+
+# http://code.patg.net/comware_5_2.tar.gz
+from comware_5_2 import Comware_5_2, Comware_5_2_Error, client_kwargs
+from ansible.module_utils.basic import *
+
+
+class Comware_5_2_Rolling_Reboot(Comware_5_2):
+    # a failing switch must not end the run for the whole fleet
+    def fail(self, message='', error=Comware_5_2_Error):
+        self.set_failed(True)
+        self.set_message(message)
+        raise error(message)
+
+    def dispatch(self):
+        self.get_facts()
+        self.reboot(wait=True,
+                    wait_timeout=self.params.get('wait_timeout'),
+                    save=self.params.get('save'))
+        # health gate: the prompt answered, now check the VLANs
+        facts = self.get_facts()
+        missing = [str(vlan_id)
+                   for vlan_id in self.params.get('expected_vlans')
+                   if str(vlan_id) not in facts['vlans']]
+        if missing:
+            self.fail("VLANs %s missing after reboot" % ", ".join(missing))
+        return self.get_reboot_stats()
+
+
+def reboot_host(module, host, results):
+    result = {'host': host, 'status': 'failed', 'rebooted': False}
+    switch = None
+    try:
+        switch = Comware_5_2_Rolling_Reboot(
+            module, **client_kwargs(module.params, host=host))
+        result.update(switch.dispatch())
+        result['status'] = 'ok'
+        result['msg'] = switch.get_message()
+    except Exception, e:
+        result['msg'] = "%s %s" % (e.__class__, e)
+    finally:
+        results[host] = result
+        if switch is not None:
+            result['rebooted'] = switch.get_changed()
+            switch.close()
+
+
+def rolling_reboot(module):
+    # a switch listed twice is rebooted once, where it is first listed
+    hosts = []
+    seen = set()
+    for host in module.params.get('hosts'):
+        if host not in seen:
+            seen.add(host)
+            hosts.append(host)
+    max_in_flight = max(1, module.params.get('max_in_flight'))
+    max_failures = module.params.get('max_failures')
+    results = {}
+    failures = 0
+    aborted = False
+
+    for start in range(0, len(hosts), max_in_flight):
+        wave = hosts[start:start + max_in_flight]
+        if aborted:
+            for host in wave:
+                results[host] = {'host': host, 'status': 'skipped'}
+            continue
+        threads = []
+        for host in wave:
+            thread = threading.Thread(target=reboot_host,
+                                      args=(module, host, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        failures += len([host for host in wave
+                         if results[host]['status'] != 'ok'])
+        if failures > max_failures:
+            aborted = True
+
+    return [results[host] for host in hosts], failures, aborted
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            hosts=dict(required=True, type='list'),
+            max_in_flight=dict(default=1, type='int'),
+            max_failures=dict(default=0, type='int'),
+            expected_vlans=dict(required=False, type='list', default=[]),
+            save=dict(required=False, type='bool', default=False),
+            username=dict(required=True),
+            password=dict(required=False),
+            timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            wait_timeout=dict(default=600, type='int'),
+            port=dict(default=22, type='int'),
+            private_key_file=dict(required=False)
+        ),
+        supports_check_mode=False,
+    )
+
+    results, failures, aborted = rolling_reboot(module)
+    rebooted = [result['host'] for result in results
+                if result.get('rebooted')]
+    msg = "%d rebooted, %d failed" % (len(rebooted), failures)
+    if aborted:
+        msg += ", aborted after exceeding %d failures" % \
+            module.params.get('max_failures')
+
+    module.exit_json(failed=failures > module.params.get('max_failures'),
+                     changed=len(rebooted) > 0,
+                     msg=msg,
+                     results=results)
+
+# entry point
+main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+
+# (c) 2014, Patrick Galbraith <patg@patg.net>
+#
+# This file is part of Ansible
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: comware_5_2_save
+version_added: 0.1
+author: Patrick Galbraith
+short_description: Save the configuration of Comware 5.2-based Switches
+requirements: [ paramiko comware_5_2 (http://code.patg.net/comware_5_2.tar.gz)]
+description:
+    - Writes the running configuration of Comware 5.2-based Switches to
+      flash once, for all tasks that ran with save and defer_save.
+      Meant to be notified as a handler.
+options:
+    force:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - Write even if no task is pending and the running configuration
+              matches the saved configuration
+    startup_cfg:
+        required: false
+        default: startup.cfg
+        description:
+            - The name of the save startup config file
+    host:
+        required: true
+        default: empty
+        description:
+            - host/ip of switch
+    username:
+        required: true
+        default: empty
+        description:
+            - username to connect to switch as
+    password:
+        required: true
+        default: empty
+        description:
+            - password to connect switch with
+    timeout:
+        required: false
+        default: 30
+        description:
+            - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+'''
+
+EXAMPLES = '''
+
+# file: switch_vlan.yml
+- hosts: localhost
+  tasks:
+  - name: create VLAN 11
+    local_action:
+      module: comware_5_2_vlan
+      host: 192.168.1.100
+      username: admin
+      password: ckrit
+      vlan_id: 11
+      save: true
+      defer_save: true
+    notify: save switch
+
+  handlers:
+  - name: save switch
+    comware_5_2_save: host=192.168.1.100 username=admin password=ckrit
+
+'''
+
+# http://code.patg.net/comware_5_2.tar.gz
+from comware_5_2 import Comware_5_2, client_kwargs
+from ansible.module_utils.basic import *
+
+
+class Comware_5_2_Save(Comware_5_2):
+    def dispatch(self):
+        return self.save_pending(force=self.params.get('force'))
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            force=dict(required=False, type='bool', default=False),
+            startup_cfg=dict(),
+            username=dict(required=True),
+            password=dict(required=False),
+            host=dict(required=True),
+            timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            port=dict(default=22, type='int'),
+            private_key_file=dict(required=False)
+        ),
+        supports_check_mode=True,
+    )
+
+    failed = False
+
+    switch = Comware_5_2_Save(module,
+                              **client_kwargs(module.params))
+
+    try:
+        pending = switch.dispatch()
+
+        module.exit_json(failed=failed,
+                         changed=switch.get_changed(),
+                         msg=switch.get_message(),
+                         dirtied_by=pending)
+    except Exception, e:
+        msg = switch.get_message() + " %s %s" % (e.__class__, e)
+        switch.fail(msg)
+
+# entry point
+main()
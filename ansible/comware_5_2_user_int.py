@@ -47,6 +47,16 @@ options:
         choices: [ false, true ]
         description:
             - if true, all changes will be written. Upon reboot, save
+            - The write is skipped when nothing was changed and the running
+              configuration already matches the saved configuration
+    defer_save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true together with save, the write is left to a
+              comware_5_2_save handler so a play saves each switch once.
+              The changes of this task are recorded as pending
     startup_cfg:
         required: false
         default: startup.cfg
@@ -69,9 +79,65 @@ options:
             - password to connect switch with
     timeout:
         required: false
-        default: 5
+        default: 30
         description:
             - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    send_window_max:
+        required: false
+        default: 8
+        description:
+            - Maximum number of configuration commands sent before their
+              echo is received. The window adapts to the measured echo
+              latency, set to 1 to send one command per round trip
     user_interface:
         required: true
         default: Must be set to valid user-interface
@@ -95,6 +161,13 @@ options:
             - ACL
             - to remove ACL set 'none'
             - to don't change ACL set 'skip'
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. Check mode uses a valid snapshot instead of reading
+              the switch again. 0 disables the snapshot
 '''
 
 EXAMPLES = '''
@@ -128,158 +201,17 @@ OR
 '''
 
 # http://code.patg.net/comware_5_2.tar.gz
-from comware_5_2 import Comware_5_2
+from comware_5_2 import Comware_5_2_User_int, client_kwargs
 from ansible.module_utils.basic import *
 
 
-class Comware_5_2_User_int(Comware_5_2):
-    def dispatch(self):
-        facts = self._handle_user_int()
-        return facts
-
-    def _handle_user_int(self):
-        facts = self.get_facts()
-        user_int = {'uint_id': self.module.params.get('user_interface_id'),
-                'uint_type': self.module.params.get('user_interface_type'),
-                'auth': self.module.params.get('authentication_mode'),
-                'in_proto': self.module.params.get('in_protocol'),
-                'acl': self.module.params.get('acl')}
-#        if user['state'] == 'absent':
-#            facts = self._delete_user(facts, user['name'])
-#        else:
-#            facts = self._save_user(facts, user)
-        # After adding or deleting vlan, save
-        if user_int['acl'] == 'skip':
-          user_int['acl'] = ''
-
-        facts = self._set_user_int(facts, user_int)
-
-        if self.module.params.get('save') is True:
-            self.save()
-
-        return facts
-
-#    def _user_exists(self, facts, name):
-#        return name in facts['current_config']['local-user']
-#
-#    def _user_changed(self, facts, user):
-#        current_user = facts['current_config']['local-user']
-#        return current_user['service-type'] == user['services']
-#
-    def _set_user_int(self, facts, user_int):
-        #self.dev_setup()
-        self.set_changed(False)
-
-        change_needed = False
-
-        for uint in user_int['uint_id']:
-           if 'auth' in user_int:
-              if user_int['auth'] not in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['authentication_mode']:
-                  change_needed = True
-
-           if 'acl' in user_int and re.match('\s*([23]\d{3}\s*(inbound|outbound)|none)',user_int['acl']):
-              if user_int['acl'] not in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['acl']:
-                  change_needed = True
-#           elif 'acl' in user_int and user_int['acl'] == 'none':
-#              if 'acl' in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]:
-#                  change_needed = True
-
-           if 'in_proto' in user_int:
-              if user_int['in_proto'] not in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['protocol_inbound']:
-                  change_needed = True
-
-        if change_needed == False:
-            self.set_changed(False)
-            self.append_message("Change not needed. ")
-            return facts
-
-
-        for uint in user_int['uint_id']:
-           self._exec_command("user-interface %s %s\n" % (user_int['uint_type'], uint),
-                              "ERROR: unable to enter user-interface view")
-           if 'auth' in user_int:
-            self._exec_command("authentication-mode %s\n" % user_int['auth'],
-                              "ERROR: unable to set authentication-mode")
-           if 'in_proto' in user_int:
-            self._exec_command("protocol inbound %s\n" % user_int['in_proto'],
-                              "ERROR: unable to set protocol-inbound")
-           if 'acl' in user_int and re.match('\s*[23]\d{3}\s*(inbound|outbound)',user_int['acl']): 
-            self._exec_command("acl %s\n" % user_int['acl'],
-                              "ERROR: unable to set acl")
-           elif 'acl' in user_int and user_int['acl'] == 'none':
-            self._exec_command("undo acl %s\n" % facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['acl'],
-                              "ERROR: unable to remove acl")
- 
-        # leave interface view
-        self._quit()
-        # refresh facts
-        facts = self.get_facts()
-        # TODO:
-
-        change_done = False
-
-        for uint in user_int['uint_id']:
-           if 'auth' in user_int:
-              if user_int['auth'] in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['authentication_mode']:
-                 change_done = True
-              else:
-                  self.fail("Failed to update user-interface %s %s authentication-mode configuration." % (user_int['uint_type'], uint))
-                  return facts
-
-           if 'acl' in user_int and re.match('\s*([23]\d{3}\s*(inbound|outbound)|none)',user_int['acl']):
-              if user_int['acl'] in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['acl']:
-                 change_done = True
-              else:
-                  self.fail("Failed to update user-interface %s %s acl configuration." % (user_int['uint_type'], uint))
-                  return facts
-#           elif 'acl' in user_int and user_int['acl'] == 'none':
-#              if 'acl' in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]:
-#                  self.fail("Failed to update user-interface %s %s acl configuration." % (user_int['uint_type'], uint))
-#                  return facts
-#              else:
-#                 change_done = True
-
-           if 'in_proto' in user_int:
-              if user_int['in_proto'] in facts['current_config']['user_interfaces'][user_int['uint_type']][str(uint)]['protocol_inbound']:
-                 change_done = True
-              else:
-                  self.fail("Failed to update user-interface %s %s protocol inbound configuration." % (user_int['uint_type'], uint))
-                  return facts
-
-
-        if change_done == True:
-            self.set_changed(True)
-        else:
-            self.set_changed(False)
-
-        return facts
-
-#    def _delete_user(self, facts, name):
-#        self.set_changed(False)
-#        if not self._user_exists(facts, name):
-#            self.fail("The user %s does not exist." % name)
-#
-#        self._send_command("undo local-user %s\n" % name,
-#                           "Unable to delete user %s" % name)
-#
-#        # refresh facts
-#        facts = self.get_facts()
-#
-#        if name not in facts['current_config']['local-user']:
-#            self.set_changed(True)
-#            self.append_message("User %s deleted\n" % name)
-#        else:
-#            self.append_message("Unable to delete user %s\n" % name)
-#
-#        return facts
-
-
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             developer_mode=dict(type='bool'),
             gather_facts=dict(required=False, type='bool', default=True),
             save=dict(type='bool', default=False),
+            defer_save=dict(type='bool', default=False),
             startup_cfg=dict(),
             username=dict(required=True),
             password=dict(required=True),
@@ -296,6 +228,16 @@ def main():
                                      'telnet']),
             acl=dict(required=False),
             timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            send_window_max=dict(default=8, type='int'),
             port=dict(default=22, type='int'),
             private_key_file=dict(required=False)
         ),
@@ -304,23 +246,17 @@ def main():
     failed = False
 
     switch = Comware_5_2_User_int(module,
-                              host=module.params.get('host'),
-                              username=module.params.get('username'),
-                              password=module.params.get('password'),
-                              timeout=module.params.get('timeout'),
-                              port=module.params.get('port'),
-                              private_key_file=
-                              module.params.get('private_key_file'))
+                                  **client_kwargs(module.params))
 
     try:
-        facts = switch.dispatch()
-        if not module.params.get('gather_facts'):
-            facts = {}
+        result = switch.run(module.params)
 
         module.exit_json(failed=failed,
-                         changed=switch.get_changed(),
-                         msg=switch.get_message(),
-                         ansible_facts=facts)
+                         changed=result['changed'],
+                         msg=result['msg'],
+                         commands=result['commands'],
+                         diff=result['diff'],
+                         ansible_facts=result['facts'])
     except Exception, e:
         msg = switch.get_message() + "%s %s" % (e.__class__, e)
         switch.fail(msg)
@@ -47,6 +47,16 @@ options:
         choices: [ false, true ]
         description:
             - if true, all changes will be written. Upon reboot, save
+            - The write is skipped when nothing was changed and the running
+              configuration already matches the saved configuration
+    defer_save:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true together with save, the write is left to a
+              comware_5_2_save handler so a play saves each switch once.
+              The changes of this task are recorded as pending
     startup_cfg:
         required: false
         default: startup.cfg
@@ -69,9 +79,65 @@ options:
             - password to connect switch with
     timeout:
         required: false
-        default: 5
+        default: 30
         description:
             - How long to wait for switch to respond
+    connect_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the TCP connection and the SSH banner
+    auth_timeout:
+        required: false
+        default: timeout
+        description:
+            - How long to wait for the switch to accept the login
+    command_timeout:
+        required: false
+        default: 300
+        description:
+            - How long the reply to a single command may take, even
+              when it keeps arriving
+    task_timeout:
+        required: false
+        default: 0
+        description:
+            - Seconds the whole task may take, every wait is cut
+              short to end by then. 0 leaves the task unbounded
+    adaptive_timeouts:
+        required: false
+        default: false
+        choices: [ false, true ]
+        description:
+            - if true, connect times, prompt round trips and the rate
+              of large displays are kept per host, and once enough
+              were seen they set the connect, read and display
+              timeouts instead of timeout and command_timeout
+    retries:
+        required: false
+        default: 2
+        description:
+            - How often a lost or refused connection is tried again,
+              and reading the facts over a session that broke
+    breaker_threshold:
+        required: false
+        default: 3
+        description:
+            - Failed connects within breaker_window after which the
+              switch is skipped until it answers a probe of its SSH
+              port. 0 never skips it
+    breaker_window:
+        required: false
+        default: 900
+        description:
+            - Seconds a failed connect counts towards breaker_threshold
+    send_window_max:
+        required: false
+        default: 8
+        description:
+            - Maximum number of configuration commands sent before their
+              echo is received. The window adapts to the measured echo
+              latency, set to 1 to send one command per round trip
     name:
         required: true
         default: Must be set to valid name
@@ -110,6 +176,13 @@ options:
         default: present
         description:
             - State of VLAN
+    facts_cache_ttl:
+        required: false
+        default: 0
+        description:
+            - Seconds a snapshot of the facts read from the switch stays
+              valid. Check mode uses a valid snapshot instead of reading
+              the switch again. 0 disables the snapshot
 '''
 
 EXAMPLES = '''
@@ -143,162 +216,17 @@ OR
 '''
 
 # http://code.patg.net/comware_5_2.tar.gz
-from comware_5_2 import Comware_5_2
+from comware_5_2 import Comware_5_2_Vlan, client_kwargs
 from ansible.module_utils.basic import *
 
 
-class Comware_5_2_Vlan(Comware_5_2):
-    def dispatch(self):
-        facts = self._handle_vlan()
-        return facts
-
-    def _handle_vlan(self):
-        facts = self.get_facts()
-        vlan = {'vlan_id': self.module.params.get('vlan_id'),
-                'vlan_name': self.module.params.get('vlan_name'),
-                'tagged_port_type': self.module.params.get('tagged_port_type'),
-                'untagged_port_type':
-                self.module.params.get('untagged_port_type'),
-                'tagged_ports': self.module.params.get('tagged_ports'),
-                'untagged_ports': self.module.params.get('untagged_ports'),
-                'state': self.module.params.get('state'),
-                'interfaces': self.module.params.get('interfaces')}
-        if vlan['state'] == 'absent':
-            facts = self._delete_vlan(facts, vlan['vlan_id'])
-        else:
-            facts = self._save_vlan(facts, vlan)
-        # After adding or deleting vlan, save
-        if self.module.params.get('save') is True:
-            self.save()
-
-        return facts
-
-    def _vlan_changed(self, facts, vlan):
-        vlan_id = str(vlan['vlan_id'])
-        if vlan_id not in facts['vlans']:
-            return False
-        existing_vlan = facts['vlans'][vlan_id]
-        if vlan['vlan_name'] != existing_vlan['Name']:
-            return True
-        if vlan['tagged_ports'] != existing_vlan['Tagged_Ports']:
-            return True
-        if vlan['untagged_ports'] != existing_vlan['Untagged_Ports']:
-            return True
-
-    def _save_vlan(self, facts, vlan):
-        #self.dev_setup()
-        # if something has changed, best to delete then recreate
-        if self._vlan_changed(facts, vlan):
-            facts = self._delete_vlan(facts, vlan['vlan_id'])
-        self.set_changed(False)
-
-        # TODO: add error handling here
-        vlan_id = str(vlan['vlan_id'])
-
-        if vlan_id in facts['vlans']:
-            self.set_changed(False)
-            self.append_message("VLAN %s already exists\n" % vlan_id)
-            return facts
-
-        self._send_command("vlan %s\n" % vlan_id,
-                           "ERROR: unable to enter VLAN ID")
-        # if user doesn't assign, name assigned by switch 000${vlan_id}
-        if vlan['vlan_name'] != "":
-            self._send_command("name %s\n" % vlan['vlan_name'],
-                               "ERROR: unable to enter VLAN name")
-
-        for port in vlan['tagged_ports']:
-            port_type = vlan['tagged_port_type']
-            if port_type == 'access':
-                msg = "ERROR: tagged ports must be 'hybrid' or 'trunk'"
-                self.set_message(msg)
-                self.module.fail_json(msg=self.get_message())
-            self._send_command("interface %s\n" % port,
-                               "ERROR: unable to enter interface view")
-            self._send_command("port link-type %s\n" % port_type,
-                               "ERROR: unable to set link type")
-            type_err = "ERROR: unable to set vlan port %s" % port_type
-            # could use else, but this is self-documenting
-            if port_type == 'hybrid':
-                self._send_command("port hybrid vlan %s tagged\n" %
-                                   vlan_id, type_err)
-            # trunk
-            else:
-                self._send_command("port trunk permit vlan %s\n" % vlan_id,
-                                   type_err)
-
-        for port in vlan['untagged_ports']:
-            port_type = vlan['untagged_port_type']
-            if port_type == 'trunk':
-                self.set_message("ERROR: untagged ports must \
-                                 be 'hybrid' or 'access'")
-                self.module.fail_json(msg=self.get_message())
-            self._send_command("interface %s\n" % port,
-                               "ERROR: unable to enter interface view")
-            self._send_command("port link-type %s\n" % port_type,
-                               "ERROR: unable to set link type")
-            type_err = "ERROR: unable to set vlan port %s" % port_type
-            # could use else, but this is self-documenting
-            if port_type == 'hybrid':
-                self._send_command("port hybrid vlan %s untagged\n" %
-                                   vlan_id, type_err)
-            # access
-            else:
-                self._send_command("port access vlan %s\n" % vlan_id, type_err)
-
-        # leave interface view
-        self._quit()
-
-        # refresh facts
-        facts = self.get_facts()
-        if vlan_id in facts['vlans']:
-            self.set_changed(True)
-            self.append_message("VLAN ID %s created\n" % vlan_id)
-        else:
-            self.append_message("Unable to create VLAN ID %s\n" % vlan_id)
-
-        return facts
-
-    def _delete_vlan(self, facts, vlan_id):
-        self.set_changed(False)
-        if type(vlan_id) is not int:
-            self.set_failed(True)
-            self.set_message("ERROR: 'id' provided is not numeric.")
-
-        if self.get_failed():
-            self.module.exit_json(failed=self.get_failed(),
-                                  changed=self.get_changed(),
-                                  msg=self.get_message())
-
-        # force to string
-        vlan_id = str(vlan_id)
-
-        if vlan_id not in facts['vlans']:
-            self.set_changed(False)
-            self.append_message("VLAN %s doesn't exist\n" % vlan_id)
-            return facts
-
-        self._send_command("undo vlan %s\n" % vlan_id,
-                           "Unable to delete vlan %s" % vlan_id)
-
-        # refresh facts
-        facts = self.get_facts()
-
-        if vlan_id not in facts['vlans']:
-            self.set_changed(True)
-            self.append_message("VLAN ID %s deleted\n" % vlan_id)
-        else:
-            self.append_message("Unable to delete VLAN ID %s\n" % vlan_id)
-
-        return facts
-
-
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             developer_mode=dict(type='bool'),
             gather_facts=dict(required=False, type='bool', default=True),
             save=dict(type='bool', default=False),
+            defer_save=dict(type='bool', default=False),
             startup_cfg=dict(),
             username=dict(required=True),
             password=dict(required=True),
@@ -321,6 +249,16 @@ def main():
             state=dict(required=False, default='present',
                        choices=['present', 'absent']),
             timeout=dict(default=30, type='int'),
+            connect_timeout=dict(required=False, type='int'),
+            auth_timeout=dict(required=False, type='int'),
+            command_timeout=dict(default=300, type='int'),
+            task_timeout=dict(default=0, type='int'),
+            adaptive_timeouts=dict(type='bool', default=False),
+            retries=dict(default=2, type='int'),
+            breaker_threshold=dict(default=3, type='int'),
+            breaker_window=dict(default=900, type='int'),
+            facts_cache_ttl=dict(default=0, type='int'),
+            send_window_max=dict(default=8, type='int'),
             port=dict(default=22, type='int'),
             private_key_file=dict(required=False)
         ),
@@ -330,23 +268,17 @@ def main():
     failed = False
 
     switch = Comware_5_2_Vlan(module,
-                              host=module.params.get('host'),
-                              username=module.params.get('username'),
-                              password=module.params.get('password'),
-                              timeout=module.params.get('timeout'),
-                              port=module.params.get('port'),
-                              private_key_file=
-                              module.params.get('private_key_file'))
+                              **client_kwargs(module.params))
 
     try:
-        facts = switch.dispatch()
-        if not module.params.get('gather_facts'):
-            facts = {}
+        result = switch.run(module.params)
 
         module.exit_json(failed=failed,
-                         changed=switch.get_changed(),
-                         msg=switch.get_message(),
-                         ansible_facts=facts)
+                         changed=result['changed'],
+                         msg=result['msg'],
+                         commands=result['commands'],
+                         diff=result['diff'],
+                         ansible_facts=result['facts'])
     except Exception, e:
         message = switch.get_message() + "%s %s" % (e.__class__, e)
         module.fail_json(msg=message)
@@ -18,9 +18,16 @@
 #
 
 import re
-import paramiko
 import os
-from collections import OrderedDict
+import time
+import hashlib
+import json
+import random
+import socket
+import select
+import errno
+import threading
+from collections import OrderedDict, Mapping
 
 
 cmd_line_mode = "_cmdline-mode on\n"
@@ -35,34 +42,812 @@ cmd_system_view = "system-view\n"
 cmd_current_config = "display current-configuration\n"
 cmd_reboot = "reboot\n"
 cmd_display_vlan_all = "display vlan all\n"
+cmd_saved_config = "display saved-configuration\n"
 
 verify_save_current_conf = \
     'Current configuration will be lost, save current configuration'
 verify_filename = 'Please input the file name'
 verify_filename_unchanged = 'To leave existing filename unchanged'
 verify_config_file_saved = 'Configuration is saved to device successfully'
+verify_confirm = '[Y/N]'
 verify_reboot = 'This command will reboot the device'
 
+# probing a rebooting switch: backoff between probes and overall bound
+reboot_probe_base = 1.0
+reboot_probe_cap = 10.0
+reboot_wait_timeout = 600
+
+# seconds the reply to one command may take, however steadily it arrives
+command_timeout = 300
+
+# Timeouts learned per host: a margin over a high percentile of the
+# recent connect times, prompt round trips and large display sizes and
+# rates, once enough of them were seen. Kept within bounds.
+latency_samples = 50
+latency_samples_min = 5
+latency_weight = 0.2
+latency_margin = 4.0
+latency_display_min = 16384
+adaptive_timeout_min = 2.0
+adaptive_timeout_max = 120.0
+
+# transient failures to connect or read are retried this often, and a
+# host whose sessions failed breaker_threshold times within
+# breaker_window seconds is skipped until it answers a probe
+connect_retries = 2
+breaker_threshold = 3
+breaker_window = 900
+
+# sockets a preflight scan keeps open at once, below what select() takes
+preflight_concurrency = 500
+
+# where per-host state (pending saves, ...) is kept between tasks
+state_dir = "~/.ansible/comware_5_2"
+
 top_level_prompt = ">"
 sys_prompt = "]"
 
+# a line the switch starts with its prompt, e.g. "<HP>" or "[HP-vlan11]"
+prompt_re = '^[\[<][^\]>\n]*[\]>]'
+error_re = '^\s*\%\s(.*)$'
+
+# bounds of the number of configuration commands kept in flight
+send_window_min = 1
+send_window_max = 8
+# commands allowed to queue up in the switch before the window shrinks
+send_backlog_low = 1.0
+send_backlog_high = 2.0
+send_latency_weight = 0.2
+
+# what the current-configuration parser looks for
+config_keywords = ['sysname',
+                   'ftp server',
+                   'telnet server',
+                   'ssh server',
+                   'ip ttl-expires',
+                   'ip unreachables',
+                   'password-recovery',
+                   'user-group']
+local_user_keywords = ['password',
+                       'authorization-attribute',
+                       'service-type']
+interface_keywords = ['edged-port',
+                      'link-mode',
+                      'link-type',
+                      'address',
+                      'binding vpn-instance',
+                      'access',
+                      'hybrid',
+                      'trunk']
+radius_scheme_keywords = ['server-type',
+                          'nas-ip',
+                          'user-name-format']
+snmp_keywords = ['sys-info contact',
+                 'sys-info location',
+                 'sys-info version',
+                 'usm-user',
+                 'group']
+uinterface_keywords = ['acl',
+                       'protocol inbound',
+                       'authentication-mode']
+
+class Comware_5_2_Error(Exception):
+    pass
+
+
+# a deadline of the session or of the whole task has passed
+class Comware_5_2_Timeout(Comware_5_2_Error):
+    pass
+
+
+# skipped, the host kept failing and does not answer the probe
+class Comware_5_2_Unreachable(Comware_5_2_Error):
+    pass
+
+
+# exponential backoff with jitter: between half and all of base * 2^attempt
+def backoff_delay(attempt, base=reboot_probe_base, cap=reboot_probe_cap):
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Compact stand-ins for the per interface, VLAN and user dicts of facts,
+# of which a large switch has many thousands. Keys the parsers know live
+# in __slots__, anything else in _extra, and they read like the dicts
+# they replace. facts_to_dict() turns them back into dicts when facts
+# leave the module.
+class _Record(object):
+    __slots__ = ('_extra',)
+    _fields = ()
+    _slots = {}
+
+    def __init__(self, items=()):
+        self._extra = None
+        for key, value in items:
+            self[key] = value
+
+    def __getitem__(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = self._slots.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            if not hasattr(self, slot):
+                raise KeyError(key)
+            delattr(self, slot)
+        elif self._extra is not None:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key, slot in self._fields if hasattr(self, slot)]
+        if self._extra is not None:
+            keys += self._extra.keys()
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class InterfaceRecord(_Record):
+    _fields = (('port link-mode', 'link_mode'),
+               ('port link-type', 'link_type'),
+               ('vlan', 'vlan'),
+               ('ip', 'ip'))
+    _slots = dict(_fields)
+    __slots__ = tuple(_slots.values())
+
+
+# a VLAN of 'display vlan all', or of the current-configuration ('name')
+class VlanRecord(_Record):
+    _fields = (('VLAN_ID', 'vlan_id'),
+               ('VLAN_Type', 'vlan_type'),
+               ('Route_Interface', 'route_interface'),
+               ('IP_Address', 'ip_address'),
+               ('Subnet_Mask', 'subnet_mask'),
+               ('Description', 'description'),
+               ('Name', 'vlan_name'),
+               ('Tagged_Ports', 'tagged_ports'),
+               ('Untagged_Ports', 'untagged_ports'),
+               ('name', 'name'))
+    _slots = dict(_fields)
+    __slots__ = tuple(_slots.values())
+
+
+class UserRecord(_Record):
+    _fields = (('password', 'password'),
+               ('authorization-attribute', 'authorization_attribute'),
+               ('service_type', 'service_type'))
+    _slots = dict(_fields)
+    __slots__ = tuple(_slots.values())
+
+
+# facts with the records turned into plain dicts, e.g. for exit_json()
+def facts_to_dict(facts):
+    if isinstance(facts, VlanSet):
+        return facts.ranges()
+    if isinstance(facts, (_Record, Mapping)):
+        return dict((key, facts_to_dict(value))
+                    for key, value in facts.items())
+    if isinstance(facts, list):
+        return [facts_to_dict(value) for value in facts]
+    return facts
+
+
+# Comware accepts at most this many VLAN IDs or 'a to b' ranges in one
+# vlan list, e.g. of 'port trunk permit vlan'
+vlan_range_items_max = 10
+
+
+# A set of VLAN IDs kept as a bitmask, bit N for VLAN N. It is built from
+# and written back as Comware's VLAN lists, where '10 to 200' is a range.
+class VlanSet(object):
+    __slots__ = ('_mask',)
+
+    def __init__(self, vlans=()):
+        self._mask = 0
+        self.update(vlans)
+
+    # VLAN IDs, numeric strings, 'a to b' and 'a-b' ranges, 'all', or a
+    # string of them as the switch prints it
+    def update(self, vlans):
+        if isinstance(vlans, VlanSet):
+            self._mask |= vlans._mask
+            return
+        if isinstance(vlans, basestring):
+            vlans = [vlans]
+        tokens = " ".join(str(vlan) for vlan in vlans)
+        tokens = tokens.replace('-', ' to ').split()
+        start = None
+        index = 0
+        while index < len(tokens):
+            if tokens[index] == 'to' and start is not None and \
+               index + 1 < len(tokens):
+                stop = self._vlan_id(tokens[index + 1])
+                self._mask |= (1 << stop + 1) - (1 << start)
+                start = None
+                index += 2
+                continue
+            if tokens[index] == 'all':
+                self._mask |= (1 << 4095) - 2
+                index += 1
+                continue
+            start = self._vlan_id(tokens[index])
+            self._mask |= 1 << start
+            index += 1
+
+    def _vlan_id(self, token):
+        vlan_id = int(token)
+        if vlan_id < 1 or vlan_id > 4094:
+            raise ValueError("VLAN ID %s is out of range" % token)
+        return vlan_id
+
+    def __contains__(self, vlan_id):
+        return bool(self._mask >> int(vlan_id) & 1)
+
+    def __iter__(self):
+        mask = self._mask
+        vlan_id = 0
+        while mask:
+            if mask & 1:
+                yield vlan_id
+            mask >>= 1
+            vlan_id += 1
+
+    def __len__(self):
+        return bin(self._mask).count('1')
+
+    def __eq__(self, other):
+        if not isinstance(other, VlanSet):
+            other = VlanSet(other)
+        return self._mask == other._mask
+
+    def issubset(self, other):
+        if not isinstance(other, VlanSet):
+            other = VlanSet(other)
+        return self._mask & ~other._mask == 0
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "VlanSet(%r)" % " ".join(self.ranges())
+
+    # the set as Comware list items: '5', '10 to 200', ...
+    def ranges(self):
+        items = []
+        start = previous = None
+        for vlan_id in self:
+            if previous is not None and vlan_id == previous + 1:
+                previous = vlan_id
+                continue
+            if start is not None:
+                items.append(self._range_item(start, previous))
+            start = previous = vlan_id
+        if start is not None:
+            items.append(self._range_item(start, previous))
+        return items
+
+    def _range_item(self, start, stop):
+        if start == stop:
+            return str(start)
+        return "%s to %s" % (start, stop)
+
+
+# commands with template's '%s' filled by the VLANs as ranges, as many
+# as it takes to stay within vlan_range_items_max items each
+def vlan_range_commands(template, vlans):
+    items = VlanSet(vlans).ranges()
+    return [template % " ".join(items[index:index + vlan_range_items_max])
+            for index in range(0, len(items), vlan_range_items_max)]
+
+
+# VLAN membership of ports from facts['vlans'], kept as bitsets both ways:
+# per VLAN a mask over an interned port table, per port a mask with bit
+# N set for VLAN N. Membership checks are a single bit test and
+# comparing or diffing port lists is set arithmetic, regardless of the
+# order the switch lists ports in. 'none' is no ports.
+class VlanMembership(object):
+    def __init__(self, vlans=None):
+        self._ports = []
+        self._port_bits = {}
+        self._vlan_ports = {'tagged': {}, 'untagged': {}}
+        self._port_vlans = {'tagged': {}, 'untagged': {}}
+        for vlan_id, vlan in (vlans or {}).items():
+            self.add(vlan_id, vlan.get('Tagged_Ports'),
+                     vlan.get('Untagged_Ports'))
+
+    def _port_bit(self, port):
+        if port not in self._port_bits:
+            # names from JSON, e.g. a facts snapshot, are unicode
+            self._port_bits[intern(str(port))] = len(self._ports)
+            self._ports.append(port)
+        return self._port_bits[port]
+
+    def port_mask(self, ports):
+        mask = 0
+        if ports and ports != 'none':
+            for port in ports:
+                mask |= 1 << self._port_bit(port)
+        return mask
+
+    def _mask_ports(self, mask):
+        return [port for bit, port in enumerate(self._ports)
+                if mask >> bit & 1]
+
+    def add(self, vlan_id, tagged_ports=None, untagged_ports=None):
+        vlan_id = int(vlan_id)
+        for tagging, ports in (('tagged', tagged_ports),
+                               ('untagged', untagged_ports)):
+            mask = self.port_mask(ports)
+            self._vlan_ports[tagging][vlan_id] = mask
+            for port in self._mask_ports(mask):
+                port_vlans = self._port_vlans[tagging]
+                port_vlans[port] = port_vlans.get(port, 0) | 1 << vlan_id
+
+    def has_port(self, vlan_id, port, tagging=None):
+        bit = self._port_bits.get(port)
+        if bit is None:
+            return False
+        for mask in self._masks(self._vlan_ports, int(vlan_id), tagging):
+            if mask >> bit & 1:
+                return True
+        return False
+
+    def _masks(self, table, key, tagging):
+        taggings = [tagging] if tagging else ['tagged', 'untagged']
+        return [table[tagging].get(key, 0) for tagging in taggings]
+
+    def ports(self, vlan_id, tagging=None):
+        mask = 0
+        for vlan_mask in self._masks(self._vlan_ports, int(vlan_id),
+                                     tagging):
+            mask |= vlan_mask
+        return self._mask_ports(mask)
+
+    # VLAN IDs on a port, in ascending order
+    def vlans(self, port, tagging=None):
+        mask = 0
+        for port_mask in self._masks(self._port_vlans, port, tagging):
+            mask |= port_mask
+        vlan_ids = []
+        vlan_id = 0
+        while mask:
+            if mask & 1:
+                vlan_ids.append(vlan_id)
+            mask >>= 1
+            vlan_id += 1
+        return vlan_ids
+
+    # ports to add to and remove from vlan_id to have exactly ports
+    def diff(self, vlan_id, tagging, ports):
+        current = self._vlan_ports[tagging].get(int(vlan_id), 0)
+        wanted = self.port_mask(ports)
+        return (self._mask_ports(wanted & ~current),
+                self._mask_ports(current & ~wanted))
+
+    def same_ports(self, vlan_id, tagging, ports):
+        return self._vlan_ports[tagging].get(int(vlan_id), 0) == \
+            self.port_mask(ports)
+
+
+def _new_config_dict():
+    return {'sysname': {},
+            'interfaces': {},
+            'vlans': {},
+            'user_interfaces': {},
+            'domain': {},
+            'snmp': {},
+            'radius_scheme': {},
+            'local_user': {}}
+
+
+# current-configuration is made of '#' delimited sections, and nothing
+# the parser looks for spans one. Hand them out as soon as each one is
+# complete so only one section is ever held.
+def _iter_config_sections(config_lines):
+    section = []
+    for line in config_lines:
+        if re.match('^#$', line):
+            if section:
+                yield section
+            section = []
+        else:
+            section.append(line)
+    if section:
+        yield section
+
+
+# sections of config_dict keyed by object (interface, VLAN ID, user, ...)
+config_object_sections = ['interfaces',
+                          'vlans',
+                          'user_interfaces',
+                          'domain',
+                          'radius_scheme',
+                          'local_user']
+
+
+# Stream (section, object_id, key, value) events out of any iterable of
+# current-configuration lines, e.g. an open file or several concatenated
+# configs, without building the whole config_dict. Each '#' delimited
+# section is parsed on its own, so:
+#   ('interfaces', 'GigabitEthernet1/0/1', 'port link-type', 'trunk')
+#   ('snmp', None, 'location', 'lab')
+#   ('global', None, 'sysname', 'HP5500')
+# Objects without any attributes, e.g. 'vlan 1', give a single event with
+# key and value None.
+def iter_config_events(config_lines):
+    for config_list in _iter_config_sections(config_lines):
+        config_dict = _new_config_dict()
+        Comware_5_2._parse_config_section(config_dict, config_list)
+        for section, value in config_dict.items():
+            if section in config_object_sections:
+                for object_id, attributes in value.items():
+                    if not attributes:
+                        yield (section, object_id, None, None)
+                    for key, attribute in attributes.items():
+                        yield (section, object_id, key, attribute)
+            elif isinstance(value, dict):
+                for key, attribute in value.items():
+                    yield (section, None, key, attribute)
+            else:
+                yield ('global', None, section, value)
+
+
+# headers of the sections ComwareConfig indexes, one object per section
+config_headers = [('interfaces', '^interface ([\w\-\/]+)$'),
+                  ('vlans', '^vlan ([\w\-\/]+)$'),
+                  ('local_user', '^local-user (\S+)$'),
+                  ('radius_scheme', '^\s*radius\s+scheme\s+(\w+)$')]
+
+
+# current-configuration indexed in one pass by where each interface,
+# VLAN, local user and radius scheme section starts. Nothing is parsed
+# until it is looked up, then it is kept. config['interfaces'] is a
+# ComwareConfigSection, so checking an interface exists parses nothing
+# and config['interfaces'][name] parses just that interface. The other
+# sections are parsed together the first time one of them is looked up.
+class ComwareConfig(Mapping):
+    def __init__(self, config_lines):
+        self._lines = []
+        self._index = dict((section, OrderedDict())
+                           for section, header in config_headers)
+        self._objects = dict((section, {})
+                             for section, header in config_headers)
+        self._other = []
+        self._other_dict = None
+        start = None
+        for line in config_lines:
+            if re.match('^#$', line):
+                self._add_section(start, len(self._lines))
+                start = None
+                continue
+            if start is None:
+                start = len(self._lines)
+            self._lines.append(line)
+        self._add_section(start, len(self._lines))
+
+    # A section may hold several objects, e.g. local-user stanzas with no
+    # '#' between them: each runs from its header to the next one.
+    def _add_section(self, start, stop):
+        if start is None:
+            return
+        current = None
+        for position in range(start, stop):
+            for section, header in config_headers:
+                m = re.match(header, self._lines[position])
+                if m:
+                    break
+            else:
+                continue
+            self._add_span(current, start, position)
+            current = (section, m.group(1))
+            start = position
+        self._add_span(current, start, stop)
+
+    def _add_span(self, current, start, stop):
+        if start == stop:
+            return
+        if current is None:
+            self._other.append((start, stop))
+        else:
+            self._index[current[0]][current[1]] = (start, stop)
+
+    def _parse(self, spans):
+        config_dict = _new_config_dict()
+        for start, stop in spans:
+            Comware_5_2._parse_config_section(config_dict,
+                                              self._lines[start:stop])
+        return config_dict
 
+    def _get_other(self):
+        if self._other_dict is None:
+            self._other_dict = self._parse(self._other)
+        return self._other_dict
+
+    def get_object(self, section, object_id):
+        objects = self._objects[section]
+        if object_id not in objects:
+            span = self._index[section][object_id]
+            objects[object_id] = \
+                self._parse([span])[section].get(object_id, {})
+        return objects[object_id]
+
+    def __getitem__(self, key):
+        if key in self._index:
+            return ComwareConfigSection(self, key)
+        return self._get_other()[key]
+
+    def __contains__(self, key):
+        return key in self._index or key in self._get_other()
+
+    def __iter__(self):
+        return iter(self._get_other())
+
+    def __len__(self):
+        return len(self._get_other())
+
+    # everything parsed, laid out like facts['current_config']
+    def to_dict(self):
+        config_dict = dict(self._get_other())
+        for section in self._index:
+            config_dict[section] = dict(self[section].items())
+        return config_dict
+
+
+class ComwareConfigSection(Mapping):
+    def __init__(self, config, section):
+        self._config = config
+        self._section = section
+
+    def __getitem__(self, object_id):
+        return self._config.get_object(self._section, object_id)
+
+    def __contains__(self, object_id):
+        return object_id in self._config._index[self._section]
+
+    def __iter__(self):
+        return iter(self._config._index[self._section])
+
+    def __len__(self):
+        return len(self._config._index[self._section])
+
+
+# module options passed on to Comware_5_2 under the same name
+client_options = ('host', 'username', 'password', 'timeout', 'port',
+                  'private_key_file', 'connect_timeout', 'auth_timeout',
+                  'command_timeout', 'task_timeout', 'adaptive_timeouts',
+                  'retries', 'breaker_threshold', 'breaker_window',
+                  'send_window_max', 'channels', 'facts_cache_ttl')
+
+
+# The Comware_5_2 keyword arguments from the params of a module, those it
+# doesn't have or leaves unset keep their defaults. overrides wins, e.g.
+# the host of each switch a module works through.
+def client_kwargs(params, **overrides):
+    kwargs = dict((key, params[key]) for key in client_options
+                  if params.get(key) is not None)
+    kwargs.update(overrides)
+    return kwargs
+
+
+# The facts snapshot of a host if it is recent enough, without opening a
+# session or building a Comware_5_2
+def cached_facts(host, facts_cache_ttl, state_dir=state_dir):
+    if not facts_cache_ttl:
+        return None
+    path = os.path.join(os.path.expanduser(state_dir), "%s.facts" % host)
+    if not os.path.exists(path) or \
+       time.time() - os.path.getmtime(path) > facts_cache_ttl:
+        return None
+    try:
+        snapshot = open(path)
+        facts = json.load(snapshot)
+        snapshot.close()
+    except ValueError:
+        return None
+    return facts
+
+
+# Probe hosts for an SSH banner on port, many at once without threads:
+# non-blocking connects and reads watched by select(), up to concurrency
+# of them open at a time, at most preflight_concurrency as select() takes
+# no more than FD_SETSIZE sockets. Each host gets timeout seconds. Returns
+# {host: banner}, banner is None when nothing accepted the connection
+# and '' when what did is not an SSH server.
+def preflight(hosts, port=22, timeout=5,
+              concurrency=preflight_concurrency):
+    concurrency = max(1, min(concurrency, preflight_concurrency))
+    results = {}
+    pending = list(hosts)
+    # socket -> [host, deadline, connected]
+    probes = {}
+
+    def finish(sock, banner):
+        results[probes.pop(sock)[0]] = banner
+        sock.close()
+
+    while pending or probes:
+        while pending and len(probes) < concurrency:
+            host = pending.pop(0)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            try:
+                error = sock.connect_ex((socket.gethostbyname(host), port))
+            except socket.error:
+                error = errno.EHOSTUNREACH
+            probes[sock] = [host, time.time() + timeout, False]
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                finish(sock, None)
+        if not probes:
+            break
+
+        connecting = [sock for sock in probes if not probes[sock][2]]
+        reading = [sock for sock in probes if probes[sock][2]]
+        wait = min(probe[1] for probe in probes.values()) - time.time()
+        readable, writable, _ = select.select(reading, connecting, [],
+                                              max(0, wait))
+        for sock in writable:
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                finish(sock, None)
+            else:
+                probes[sock][2] = True
+        for sock in readable:
+            try:
+                banner = sock.recv(256)
+            except socket.error:
+                banner = ''
+            if not banner.startswith('SSH-'):
+                banner = ''
+            finish(sock, banner.strip())
+
+        now = time.time()
+        for sock in [sock for sock in probes if probes[sock][1] <= now]:
+            finish(sock, '' if probes[sock][2] else None)
+    return results
+
+
+# Have the next session with host probe it first, as if it had failed
+# breaker_threshold times already. For hosts a preflight found dead.
+def mark_unreachable(host, breaker_threshold=breaker_threshold,
+                     state_dir=state_dir):
+    state_dir = os.path.expanduser(state_dir)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    path = os.path.join(state_dir, "%s.breaker" % host)
+    store = open(path + '.tmp', 'w')
+    json.dump({'failures': breaker_threshold, 'failed_at': time.time()},
+              store)
+    store.close()
+    os.rename(path + '.tmp', path)
+
+
+# Without a module the client raises Comware_5_2_Error where a module
+# would fail, and takes its settings from the keyword arguments only, so
+# it can be kept open by a long-running process. With a module, settings
+# left to None are read from the module parameters. The operations of the
+# subclasses take their options from params, those of the module or the
+# ones given to run().
 class Comware_5_2(object):
+    operation = None
+
     def __init__(self,
-                 module,
-                 host,
-                 username,
-                 password,
-                 timeout,
+                 module=None,
+                 host=None,
+                 username=None,
+                 password=None,
+                 timeout=30,
                  port=22,
-                 private_key_file=None):
+                 private_key_file=None,
+                 send_window_max=send_window_max,
+                 state_dir=state_dir,
+                 channels=1,
+                 facts_cache_ttl=0,
+                 startup_cfg=None,
+                 defer_save=None,
+                 check_mode=None,
+                 connect_timeout=None,
+                 auth_timeout=None,
+                 command_timeout=command_timeout,
+                 task_timeout=0,
+                 adaptive_timeouts=False,
+                 retries=connect_retries,
+                 breaker_threshold=breaker_threshold,
+                 breaker_window=breaker_window):
         self.module = module
+        params = getattr(module, 'params', {})
+        self.params = params
+        if startup_cfg is None:
+            startup_cfg = params.get('startup_cfg')
+        if defer_save is None:
+            defer_save = params.get('defer_save')
+        if check_mode is None:
+            check_mode = getattr(module, 'check_mode', False)
         self.host = host
         self.username = username
         self.password = password
         self.port = port
         self.private_key_file = private_key_file
         self.timeout = timeout
+        # Each phase has its own bound, connect and auth default to
+        # timeout, which stays the longest a single read may wait. All of
+        # them are cut short by the end of the task, if task_timeout is set.
+        self.connect_timeout = connect_timeout or timeout
+        self.auth_timeout = auth_timeout or timeout
+        self.command_timeout = command_timeout
+        self._task_deadline = None
+        if task_timeout:
+            self._task_deadline = time.time() + task_timeout
+        self.state_dir = os.path.expanduser(state_dir)
+        # latency samples of earlier sessions with this host, and the
+        # silence a prompt or display read waits for as learned from them.
+        # Saves, reboots and configuration keep timeout, the switch may
+        # well pause longer than any prompt took.
+        self.adaptive_timeouts = adaptive_timeouts
+        self._latency = {}
+        if adaptive_timeouts:
+            self._latency = self._load_latency()
+        self._read_timeout = self._learned_timeout('prompt', timeout)
+        # breaker_threshold 0 never skips the host
+        self.retries = retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_window = breaker_window
+        # shells opened on the same transport for concurrent displays
+        self.channels = max(1, channels)
+        self._channel_pool = []
+        # seconds a facts snapshot stays usable, 0 disables the snapshot
+        self.facts_cache_ttl = facts_cache_ttl
+        self.startup_cfg = startup_cfg
+        self.defer_save = defer_save
+        self._check_mode = check_mode
+        # configuration commands of this session, sent or (check mode) not
+        self._commands = []
+        self._diff = {}
         self._failed = False
         self._changed = False
         self._message = ""
@@ -70,6 +855,152 @@ class Comware_5_2(object):
         self._system_view = False
         self._top_level_view = False
         self._paging_disabled = False
+        # set by any configuration change issued during this session
+        self._dirty = False
+        self._send_window = send_window_min
+        self._send_window_max = max(send_window_min, send_window_max)
+        self._echo_latency = None
+        self._echo_latency_min = None
+        self._send_acks = 0
+        self._reboot_stats = {}
+        # while a batch runs: the facts read at its start, and the checks
+        # of what was changed, run with one read at its end
+        self._batch_facts = None
+        self._deferred_checks = None
+        # the facts['vlans'] last indexed, and its VlanMembership
+        self._membership = None
+        # set while a read may be retried, a broken session raises then
+        self._reading = False
+        # set while _run_parallel runs jobs, fail() raises then
+        self._parallel = False
+
+    # The session is opened on first use of ssh or channel, so answers
+    # from the facts snapshot and check mode runs never connect.
+    def __getattr__(self, name):
+        if name not in ('ssh', 'channel'):
+            raise AttributeError(name)
+        try:
+            self._open_session()
+        except Exception, e:
+            message = "%s %s" % (e.__class__, e)
+            if isinstance(e, Comware_5_2_Error):
+                self.fail(message, e.__class__)
+            self.fail(message)
+        return self.__dict__[name]
+
+    # A lost connection, a reset or a refused session may well work the
+    # next time. Bad credentials and missed deadlines won't.
+    def _transient(self, e):
+        import paramiko
+
+        if isinstance(e, paramiko.AuthenticationException):
+            return False
+        return isinstance(e, (socket.error, EOFError, paramiko.SSHException))
+
+    # wait before the next attempt, if the task leaves time for it
+    def _backoff(self, attempt, what):
+        time.sleep(min(backoff_delay(attempt),
+                       self._remaining(reboot_probe_cap, what)))
+
+    def _open_session(self):
+        self._check_breaker()
+        attempt = 0
+        while True:
+            try:
+                self._connect()
+                break
+            except Exception, e:
+                if not self._transient(e):
+                    raise
+                if attempt >= self.retries:
+                    self._trip_breaker()
+                    raise
+            self._backoff(attempt, "connect")
+            attempt += 1
+        self._reset_breaker()
+
+    # drop a broken session, the next use of the channel opens another
+    def _reopen_session(self):
+        self._channel_pool = []
+        if 'ssh' in self.__dict__:
+            try:
+                self.ssh.close()
+            except Exception:
+                pass
+            del self.ssh, self.channel
+        self._developer_mode_set = False
+
+    # Run a read that changes nothing again on a new session if the
+    # session broke. Reads on a pool channel, or within a read already
+    # retried, are left to the outer read.
+    def _retry_read(self, read, channel=None):
+        if channel is not None or self._reading:
+            return read()
+        attempt = 0
+        self._reading = True
+        try:
+            while True:
+                try:
+                    return read()
+                except Exception, e:
+                    if not self._transient(e) or attempt >= self.retries:
+                        raise
+                self._reopen_session()
+                self._backoff(attempt, "read again")
+                attempt += 1
+        finally:
+            self._reading = False
+
+    def _load_breaker(self):
+        path = self._state_file('breaker')
+        if not os.path.exists(path):
+            return {}
+        try:
+            store = open(path)
+            breaker = json.load(store)
+            store.close()
+        except ValueError:
+            return {}
+        return breaker
+
+    def _check_breaker(self):
+        if not self.breaker_threshold:
+            return
+        breaker = self._load_breaker()
+        if breaker.get('failures', 0) < self.breaker_threshold or \
+           time.time() - breaker['failed_at'] > self.breaker_window:
+            return
+        if not self._probe_ssh(min(self.connect_timeout, reboot_probe_cap)):
+            self._trip_breaker()
+            raise Comware_5_2_Unreachable(
+                "%s failed %d times in a row and does not answer on port %d"
+                % (self.host, breaker['failures'], self.port))
+
+    def _trip_breaker(self):
+        if not self.breaker_threshold:
+            return
+        breaker = self._load_breaker()
+        failures = breaker.get('failures', 0)
+        if breaker and time.time() - breaker['failed_at'] > \
+           self.breaker_window:
+            failures = 0
+        path = self._state_file('breaker')
+        store = open(path + '.tmp', 'w')
+        json.dump({'failures': failures + 1, 'failed_at': time.time()},
+                  store)
+        store.close()
+        os.rename(path + '.tmp', path)
+
+    def _reset_breaker(self):
+        if not self.breaker_threshold:
+            return
+        path = self._state_file('breaker')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _connect(self):
+        # paramiko is slow to import and only needed to talk to the switch
+        import paramiko
 
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -89,28 +1020,35 @@ class Comware_5_2(object):
         if self.password is not None:
             allow_agent = False
 
+        connect_timeout = self._remaining(
+            self._learned_timeout('connect', self.connect_timeout), "connect")
+        connect_started = time.time()
         try:
             ssh.connect(self.host,
+                        port=self.port,
                         username=self.username,
                         password=self.password,
                         key_filename=key_filename,
                         allow_agent=allow_agent,
                         look_for_keys=False,
-                        timeout=self.timeout)
-        # TODO: more specific error-handling (?)
-        except Exception, e:
-            message = "%s %s" % (e.__class__, e)
-            self.fail(message)
+                        timeout=connect_timeout,
+                        banner_timeout=connect_timeout,
+                        auth_timeout=self._remaining(self.auth_timeout,
+                                                     "authenticate"))
+            self._record_latency('connect', time.time() - connect_started)
+            self._store_latency()
+            channel = ssh.invoke_shell()
+        except Exception:
+            # a client that failed half way may still hold its socket
+            ssh.close()
+            raise
 
         self._top_level_view = True
+        self._system_view = False
+        self._paging_disabled = False
 
         self.ssh = ssh
-        try:
-            self.channel = ssh.invoke_shell()
-        except Exception, e:
-            message = "%s %s" % (e.__class__, e)
-            self.fail(message)
-
+        self.channel = channel
         self.channel.settimeout(self.timeout)
 
     def get_failed(self):
@@ -127,6 +1065,33 @@ class Comware_5_2(object):
 
     def set_changed(self, state):
         self._changed = state
+        if state:
+            self._dirty = True
+
+    def get_dirty(self):
+        return self._dirty
+
+    def get_check_mode(self):
+        return self._check_mode
+
+    def get_commands(self):
+        return self._commands
+
+    def get_diff(self):
+        return self._diff
+
+    # Inside a batch, keep a check of what was just pushed for when the
+    # batch is done. check(facts) is true when the switch is as asked.
+    # Outside a batch this is false and the caller verifies right away.
+    def _defer_verify(self, msg, check):
+        if self._deferred_checks is None:
+            return False
+        self._deferred_checks.append((msg, check))
+        return True
+
+    def set_diff(self, before, after):
+        self._diff = {'before': facts_to_dict(before),
+                      'after': facts_to_dict(after)}
 
     def set_message(self, message):
         self._message = message
@@ -134,11 +1099,45 @@ class Comware_5_2(object):
     def append_message(self, message):
         self._message += message
 
-    def fail(self, message=''):
+    # Run the operation of the class with params, the options of its module
+    # (e.g. {'vlan_id': 10, 'vlan_name': 'users'} for Comware_5_2_Vlan), the
+    # ones left out take the defaults of the module. Returns what the module
+    # reports.
+    def run(self, params):
+        self.params = {'gather_facts': True, 'save': False}
+        self.params.update(operation_defaults.get(self.operation, {}))
+        self.params.update(params)
+        facts = self.dispatch()
+        if not self.params.get('gather_facts'):
+            facts = {}
+        return {'changed': self.get_changed(),
+                'msg': self.get_message(),
+                'commands': self.get_commands(),
+                'diff': self.get_diff(),
+                'facts': facts_to_dict(facts)}
+
+    def fail(self, message='', error=Comware_5_2_Error):
         self.set_failed(True)
         self.set_message(message)
+        if self.module is None or self._parallel:
+            raise error(message)
         self.module.fail_json(msg=self.get_message())
 
+    def close(self):
+        for channel in self._channel_pool:
+            channel.close()
+        self._channel_pool = []
+        self._store_latency()
+        if 'ssh' in self.__dict__:
+            self.ssh.close()
+            del self.ssh, self.channel
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def _developer_mode(self):
         error_message = "ERROR: Unable to switch to developer mode"
         self._send_command(cmd_line_mode, error_message)
@@ -146,14 +1145,142 @@ class Comware_5_2(object):
         self._send_command(cmd_line_mode_resp, error_message)
         self._developer_mode_set = True
 
-    def _send_command(self, command, msg=""):
+    def _send_command(self, command, msg="", channel=None):
+        if channel is None:
+            channel = self.channel
         try:
-            self.channel.send(command)
+            channel.send(command)
         except Exception, e:
+            if self._reading and self._transient(e):
+                raise
             msg = msg + "%s %s" % (e.__class__, e)
             self.fail(msg)
 
+    # the earlier of timeout seconds from now and the end of the task
+    def _deadline(self, timeout):
+        deadline = time.time() + timeout
+        if self._task_deadline is not None:
+            deadline = min(deadline, self._task_deadline)
+        return deadline
+
+    def _remaining(self, timeout, what):
+        remaining = self._deadline(timeout) - time.time()
+        if remaining <= 0:
+            raise Comware_5_2_Timeout("no time left to %s" % what)
+        return remaining
+
+    # One read that does not wait past deadline, nor longer than silence
+    # (timeout unless given) when the switch is silent.
+    def _recv(self, channel, deadline, what, silence=None):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Comware_5_2_Timeout("timed out waiting for %s" % what)
+        channel.settimeout(min(silence or self.timeout, remaining))
+        try:
+            return channel.recv(1024)
+        except socket.timeout:
+            raise Comware_5_2_Timeout("timed out waiting for %s" % what)
+
+    def _drain_channel(self):
+        while self.channel.recv_ready():
+            self.channel.recv(1024)
+
+    def get_send_window(self):
+        return self._send_window
+
+    def get_echo_latency(self):
+        return self._echo_latency
+
+    # The lowest echo latency seen is the round trip of an idle switch.
+    # Anything above it, multiplied by the window, estimates how many
+    # commands are queued in the switch CLI. The window is adjusted once
+    # per window of echoes to keep that backlog between the two bounds.
+    def _update_send_window(self, latency):
+        self._record_latency('prompt', latency)
+        if self._echo_latency is None:
+            self._echo_latency = latency
+        else:
+            self._echo_latency += (latency - self._echo_latency) * \
+                send_latency_weight
+        if self._echo_latency_min is None or latency < self._echo_latency_min:
+            self._echo_latency_min = latency
+
+        self._send_acks += 1
+        if self._send_acks < self._send_window:
+            return
+        self._send_acks = 0
+        backlog = self._send_window * \
+            (1 - self._echo_latency_min / max(latency, 1e-6))
+        if backlog > send_backlog_high:
+            self._send_window = max(send_window_min, self._send_window - 1)
+        elif backlog < send_backlog_low:
+            self._send_window = min(self._send_window_max,
+                                    self._send_window + 1)
+
+    # every configuration change goes through here, in check mode the
+    # commands are only recorded
+    def _push_config(self, commands, msg=""):
+        self._commands += [command.strip() for command in commands]
+        if self._check_mode:
+            return
+        self._drop_cached_facts()
+        self._send_commands(commands, msg)
+
+    # Send configuration commands keeping up to _send_window of them in
+    # flight. The switch echoes every command and prints a new prompt once
+    # it is processed, so every line starting with a prompt acknowledges
+    # the oldest command still in flight.
+    def _send_commands(self, commands, msg=""):
+        self._dirty = True
+        self._drain_channel()
+        pending = list(commands)
+        in_flight = []
+        output_buf = ""
+        prompt_counted = False
+        deadline = self._deadline(self.command_timeout)
+        while pending or in_flight:
+            while pending and len(in_flight) < self._send_window:
+                command = pending.pop(0)
+                self._send_command(command, msg)
+                in_flight.append((command, time.time()))
+
+            read_buf = self._recv(self.channel, deadline,
+                                  "the switch to take the configuration")
+            if not read_buf:
+                self.fail(msg + " Switch closed the session")
+            output_buf += read_buf.replace("\r", "")
+            lines = output_buf.split('\n')
+            output_buf = lines.pop()
+
+            # Each prompt acknowledges the oldest command in flight as it
+            # is read, so an error is blamed on the command echoed last.
+            now = time.time()
+            for line in lines:
+                m = re.match(error_re, line)
+                if m and m.group(1) and in_flight:
+                    self._send_window = send_window_min
+                    message = msg + \
+                        ". Switch ERROR: command %s failed with %s" % \
+                        (in_flight[0][0].strip(), m.group(1))
+                    self.fail(message)
+                if re.match(prompt_re, line):
+                    if prompt_counted:
+                        prompt_counted = False
+                    elif in_flight:
+                        self._ack_command(in_flight, now)
+            # a bare prompt means the last command sent is done
+            if re.match(prompt_re + '$', output_buf) and not prompt_counted:
+                prompt_counted = True
+                if in_flight:
+                    self._ack_command(in_flight, now)
+        self._store_latency()
+
+    def _ack_command(self, in_flight, now):
+        command, sent_at = in_flight.pop(0)
+        self._update_send_window(now - sent_at)
+
     def _exec_command(self, command, msg=""):
+        self._dirty = True
         try:
             self.channel.send(command)
         except Exception, e:
@@ -168,20 +1295,122 @@ class Comware_5_2(object):
                     (command, m.group(1))
                 self.fail(message)
 
-    def save(self):
-        cmd_confirm = cmd_no
-        if self.module.params.get('save') is True:
-            cmd_confirm = cmd_yes
+    # Writing flash is slow and wears it out, so only save when something
+    # was changed during this session or the running configuration differs
+    # from the saved one.
+    def save(self, force=False):
+        if self._check_mode:
+            return False
+        if self.defer_save:
+            self._mark_pending_save()
+            return False
+        if not force and not self._dirty and self._config_saved():
+            self.append_message("Configuration unchanged, save skipped. ")
+            return False
 
         cmd_file_name = "\n"
-        if self.module.params.get('startup_cfg'):
-            cmd_file_name = "flash:/" + self.module.params.get('startup_cfg') \
-                            + cmd_file_name
+        if self.startup_cfg:
+            cmd_file_name = "flash:/" + self.startup_cfg + cmd_file_name
+        self._drain_channel()
         self._send_command(cmd_save, "ERROR: unable to save config")
-        self._send_command(cmd_confirm, "ERROR: unable to save config")
-        self._send_command(cmd_file_name, "ERROR: unable to save %s"
-                           % cmd_file_name)
+        output_buf = ""
+        deadline = self._deadline(self.command_timeout)
+        while verify_config_file_saved not in output_buf:
+            read_buf = self._recv(self.channel, deadline,
+                                  "the configuration to be saved")
+            if not read_buf:
+                self.fail("ERROR: session closed while saving config")
+            output_buf += read_buf.replace("\r", "")
+            # only complete lines, an error may arrive over several reads
+            m = re.search(error_re, output_buf[:output_buf.rfind("\n") + 1],
+                          re.MULTILINE)
+            if m and m.group(1):
+                self.fail("ERROR: unable to save config. Switch ERROR: %s" %
+                          m.group(1))
+            # answer each prompt once, then wait for the next one
+            if verify_filename in output_buf:
+                self._send_command(cmd_file_name, "ERROR: unable to save %s"
+                                   % cmd_file_name)
+                output_buf = ""
+            elif verify_confirm in output_buf:
+                self._send_command(cmd_yes, "ERROR: unable to save config")
+                output_buf = ""
+
+        self._dirty = False
         self._developer_mode_set = True
+        self.append_message("Configuration saved. ")
+        return True
+
+    def _state_file(self, name):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        return os.path.join(self.state_dir, "%s.%s" % (self.host, name))
+
+    # leave the write to a later save (the comware_5_2_save module), just
+    # remember which task changed the configuration
+    def _mark_pending_save(self):
+        if not self._dirty:
+            return
+        reason = self.get_message().strip().split("\n")[0]
+        pending = open(self._state_file('pending_save'), 'a')
+        pending.write("%s: %s\n" % (self.__class__.__name__, reason))
+        pending.close()
+        self.append_message("Save deferred. ")
+
+    def get_pending_save(self):
+        path = self._state_file('pending_save')
+        if not os.path.exists(path):
+            return []
+        pending = open(path)
+        reasons = [line.rstrip("\n") for line in pending if line.strip()]
+        pending.close()
+        return reasons
+
+    def clear_pending_save(self):
+        path = self._state_file('pending_save')
+        if os.path.exists(path):
+            os.remove(path)
+
+    # The save the comware_5_2_save module does for the tasks that
+    # deferred theirs. Check mode reports a pending or forced save without
+    # opening a session, the pending saves stay for the real run.
+    def save_pending(self, force=False):
+        pending = self.get_pending_save()
+        force = force or len(pending) > 0
+        if self._check_mode:
+            self.set_changed(force)
+            if force:
+                self.append_message("Configuration would be saved. ")
+        else:
+            self.dev_setup()
+            self.set_changed(self.save(force=force))
+            self.clear_pending_save()
+        for reason in pending:
+            self.append_message("\n%s" % reason)
+        return pending
+
+    def _config_saved(self):
+        return self._get_config_hash(cmd_current_config) == \
+            self._get_config_hash(cmd_saved_config)
+
+    # hash the configuration from its 'version' line on, the echo and
+    # anything before it differs between current and saved configuration
+    def _get_config_hash(self, command):
+        return self._retry_read(lambda: self._read_config_hash(command))
+
+    def _read_config_hash(self, command):
+        if not self._paging_disabled:
+            self._disable_paging()
+        self._drain_channel()
+        self._send_command(command, "ERROR: unable to display configuration")
+        digest = hashlib.md5()
+        started = False
+        for line in self._get_output_list(command.strip()):
+            if not started:
+                started = re.match('^\s*version\s', line) is not None
+            if started:
+                digest.update(line.rstrip() + "\n")
+        return digest.hexdigest()
 
     def _quit(self):
         self._send_command(cmd_quit, "ERROR: unable to quit level")
@@ -199,41 +1428,73 @@ class Comware_5_2(object):
                            "ERROR: unable to disable paging")
         self._paging_disabled = True
 
-    def _get_output(self, start='', end=""):
-        output_buf = ""
-        append_flag = False
-        expect_end = False
+    # hand out output chunks as they are received, from the chunk 'start'
+    # shows up in until the switch prints its prompt again
+    def _iter_output(self, start='', end="", channel=None):
+        if channel is None:
+            channel = self.channel
+        if end == "":
+            end = '(' + top_level_prompt + '|' +\
+                  re.escape(sys_prompt) + ')'
+        started = False
+        carry = ""
+        line = None
+        deadline = self._deadline(self._learned_display_timeout())
+        received = 0
+        read_started = time.time()
         while True:
-            read_buf = self.channel.recv(1024)
+            read_buf = self._recv(channel, deadline, "the command output",
+                                  self._read_timeout)
+            if not read_buf:
+                raise socket.error("session closed")
+            if not received:
+                self._record_latency('prompt', time.time() - read_started)
+            received += len(read_buf)
             read_buf = read_buf.replace("\r", "")
 
-            if start in read_buf:
-                expect_end = True
-                append_flag = True
-
-            if append_flag:
-                output_buf += read_buf
-
-            if end == "":
-                end = '(' + top_level_prompt + '|' +\
-                      re.escape(sys_prompt) + ')'
-            if re.match('.*\n' + end + '$', read_buf, re.DOTALL) \
-               and expect_end:
-                break
-            if re.match('.*\n[\[<].*[\]>]$', read_buf, re.DOTALL) \
-               and expect_end:
+            if not started:
+                # start may be split over two reads
+                if start in read_buf:
+                    started = True
+                elif start in carry + read_buf:
+                    started = True
+                    read_buf = carry + read_buf
+                else:
+                    carry = (carry + read_buf)[-len(start):]
+                    continue
+            yield read_buf
+
+            # the prompt is whatever follows the last newline, which may
+            # have been received over several reads
+            if '\n' in read_buf:
+                line = read_buf[read_buf.rfind('\n') + 1:]
+            elif line is not None:
+                line += read_buf
+            if line is not None and \
+               (re.match(end + '$', line) or re.match(prompt_re + '$', line)):
                 break
-        return output_buf
-
-    def _get_output_list(self, start='', keep_prompt=False):
-        output_buf = self._get_output(start)
-
-        output_list = output_buf.split('\n')
-        list_length = len(output_list)
-        if not keep_prompt:
-            list_length -= 1
-
-        return output_list[0:list_length]
+        if received >= latency_display_min:
+            self._record_latency('display_bytes', received)
+            self._record_latency('display_rate', received /
+                                 max(time.time() - read_started, 1e-6))
+
+    def _get_output(self, start='', end="", channel=None):
+        return "".join(self._iter_output(start, end, channel))
+
+    # same as _iter_output, but in complete lines. The prompt the output
+    # ends with is dropped unless keep_prompt.
+    def _iter_output_lines(self, start='', keep_prompt=False, channel=None):
+        pending = ""
+        for read_buf in self._iter_output(start, channel=channel):
+            lines = (pending + read_buf).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if keep_prompt:
+            yield pending
+
+    def _get_output_list(self, start='', keep_prompt=False, channel=None):
+        return list(self._iter_output_lines(start, keep_prompt, channel))
 
     def _get_summary(self):
         summary_start = "Select menu option:             Summary"
@@ -276,68 +1537,120 @@ class Comware_5_2(object):
 
         return summary_dict
 
-    def _run_current_config(self):
-        self._set_system_view()
+    def _run_current_config(self, channel=None):
+        if channel is None:
+            self._set_system_view()
         self._send_command(cmd_current_config,
-                           "ERROR: unable to get switch current config")
+                           "ERROR: unable to get switch current config",
+                           channel)
 
     # get a clean dictionary representation of current config output for facts
     # TODO: work into a dict with specific parsing phrases. No easy way
     # to do this!
-    def _get_current_config(self):
+    def _get_current_config(self, channel=None):
+        self._run_current_config(channel)
+        # parsed while it is still being received
+        config_dict = self._get_config_dict(self._iter_config_lines(channel))
+        if channel is None:
+            self._quit()
+        return config_dict
+
+    # iter_config_events() over the switch's current-configuration, as it
+    # is being received
+    def iter_config_events(self):
+        self.dev_setup()
+        self._run_current_config()
+        for event in iter_config_events(self._iter_config_lines()):
+            yield event
+        self._quit()
+
+    # the current-configuration as a ComwareConfig, which leaves parsing
+    # a section until it is looked up. Like get_facts(), this leaves the
+    # switch in system-view, ready for configuration commands.
+    def get_config(self):
+        return self._retry_read(self._read_config)
+
+    def _read_config(self):
+        self.dev_setup()
         self._run_current_config()
-        return self._get_config_dict(self._get_config_list())
+        return ComwareConfig(self._iter_config_lines())
+
+    def _iter_config_lines(self, channel=None):
+        return self._iter_output_lines('version', channel=channel)
+
+    def _get_config_list(self, channel=None):
+        return list(self._iter_config_lines(channel))
 
-    def _get_config_list(self):
-        return self._get_output_list('version')
+    # output of a display command, without its echo and what came before
+    def _display_lines(self, command, channel=None):
+        if not self._paging_disabled:
+            self._disable_paging()
+        if channel is None:
+            # like get_facts(), leave the switch ready for configuration
+            self._set_system_view()
+            self._drain_channel()
+        self._send_command(command + "\n", "ERROR: unable to run %s" %
+                           command, channel)
+        skipped = []
+        echoed = False
+        for line in self._iter_output_lines(command, channel=channel):
+            if echoed:
+                yield line
+            elif command in line:
+                echoed = True
+            else:
+                skipped.append(line)
+        # no echo to be found, all of it is output
+        if not echoed:
+            for line in skipped:
+                yield line
+
+    # Let the switch filter the configuration so only the lines asked for
+    # are transferred and parsed. The result has the layout of
+    # facts['current_config'], holding just what matched.
+    def get_config_include(self, pattern, channel=None):
+        return self._retry_read(lambda: self._get_config_dict(
+            self._display_lines("display current-configuration | include %s"
+                                % pattern, channel)), channel)
+
+    def get_config_begin(self, pattern, channel=None):
+        return self._retry_read(lambda: self._get_config_dict(
+            self._display_lines("display current-configuration | begin %s"
+                                % pattern, channel)), channel)
+
+    # the sysname from the one configuration line holding it, or from the
+    # prompt while the switch still has its default name
+    def get_hostname(self):
+        return self._retry_read(self._read_hostname)
+
+    def _read_hostname(self):
+        sysname = self.get_config_include('sysname')['sysname']
+        if sysname:
+            return sysname
+        return self._get_prompt_line()[1:-1]
+
+    def get_interface_config(self, interface, channel=None):
+        return self._retry_read(lambda: self._get_config_dict(
+            self._display_lines("display current-configuration interface %s"
+                                % interface, channel)), channel)
 
     # OK, this method was very tricky. Probably endless way to do this better
     # but this works best for the varying output the switch gives you
-    def _get_config_dict(self, config_list):
-        keywords = ['sysname',
-                    'ftp server',
-                    'telnet server',
-                    'ssh server',
-                    'ip ttl-expires',
-                    'ip unreachables',
-                    'password-recovery',
-                    'user-group']
-        local_user_keywords = ['password',
-                               'authorization-attribute',
-                               'service-type']
-        interface_keywords = ['edged-port',
-                              'link-mode',
-                              'link-type',
-                              'address',
-                              'binding vpn-instance',
-                              'access',
-                              'hybrid',
-                              'trunk']
-        radius_scheme_keywords = ['server-type',
-                                  'nas-ip',
-                                  'user-name-format']
-        snmp_keywords = ['sys-info contact',
-                         'sys-info location',
-                         'sys-info version',
-                         'usm-user',
-                         'group']
-        uinterface_keywords = ['acl',
-                               'protocol inbound',
-                               'authentication-mode']
-        config_dict = {'sysname': {},
-                       'interfaces': {},
-                       'vlans': {},
-                       'user_interfaces': {},
-                       'domain': {},
-                       'snmp': {},
-                       'radius_scheme': {},
-                       'local_user': {}}
+    def _get_config_dict(self, config_lines):
+        config_dict = _new_config_dict()
+        for config_list in _iter_config_sections(config_lines):
+            self._parse_config_section(config_dict, config_list)
+        return config_dict
+
+    # add what one '#' delimited section holds to config_dict
+    @staticmethod
+    def _parse_config_section(config_dict, config_list):
         # OK, maybe this has some duplication, but parsing through
         # current-configuration is somewhat tricky.
         # TODO: break into methods and make generic as possible
         i = 0
         for line in config_list:
-            for keyword in keywords:
+            for keyword in config_keywords:
                 if keyword in line:
                     m = re.search(keyword + " (.*)$", line, re.DOTALL)
                     if m and len(m.group(1)):
@@ -345,8 +1658,8 @@ class Comware_5_2(object):
                         config_dict[keyword] = value
             m = re.search('^interface ([\w\-\/]+)$', line, re.DOTALL)
             if m and len(m.group(1)):
-                interface = m.group(1)
-                config_dict['interfaces'][interface] = {}
+                interface = intern(m.group(1))
+                config_dict['interfaces'][interface] = InterfaceRecord()
                 vdict = {'tagged': {}, 'untagged': {}}
                 vdict_flag = False
                 ipdict = {'ipv4': {}, 'ipv6': {}}
@@ -385,7 +1698,10 @@ class Comware_5_2(object):
                                     else:
                                         tagged_state = value[len(value)-1]
                                         value = value[0:len(value)-1]
-                                    vdict[tagged_state][key] = value
+                                    # the same list may be split over
+                                    # several lines
+                                    vdict[tagged_state].setdefault(
+                                        key, VlanSet()).update(value)
                         elif m2 and len(m2.group(1)) and len(m2.group(2)):
                           if m2.group(1) == 'ip':
                            ipdict_flag = True
@@ -466,8 +1782,8 @@ class Comware_5_2(object):
 
             m = re.search('^vlan ([\w\-\/]+)$', line, re.DOTALL)
             if m and len(m.group(1)):
-                vlan_id = m.group(1)
-                config_dict['vlans'][vlan_id] = {}
+                vlan_id = intern(m.group(1))
+                config_dict['vlans'][vlan_id] = VlanRecord()
                 for iline in config_list[i:len(config_list)]:
                     if re.match('^#$', iline):
                         break
@@ -620,16 +1936,16 @@ class Comware_5_2(object):
                               config_dict['snmp'][skey][svalue[1]][svalue[contline]] = svalue[contline+1]
 
 
-            m = re.search('^lcal-user ([\w\-\/]+)$', line, re.DOTALL)
+            m = re.search('^local-user (\S+)$', line, re.DOTALL)
             if m and len(m.group(1)):
-                user_id = m.group(1)
-                config_dict['local_user'][user_id] = {}
+                user_id = intern(m.group(1))
+                config_dict['local_user'][user_id] = UserRecord()
                 # something to collect services that are enabled
                 services_enabled = []
                 for iline in config_list[i+1:len(config_list)]:
                     if re.match('^#$', iline):
                         break
-                    if re.match('^local_user ([\w\-\/]+)$', iline):
+                    if re.match('^local-user (\S+)$', iline):
                         break
                     # possible output following 'local-user'
                     for key in local_user_keywords:
@@ -647,26 +1963,27 @@ class Comware_5_2(object):
                     services_enabled
             i += 1
 
-        self._quit()
-        return config_dict
-
     def _get_prompt(self):
         self._send_command("\n")
         self._send_command("\n")
         prompt_list = self._get_output_list('HP', keep_prompt=True)
         return prompt_list[len(prompt_list) - 1]
 
-    def _get_vlans(self):
-        vlan_buf_list = []
+    def _get_vlans(self, channel=None):
+        if channel is None:
+            self._set_system_view()
+        self._send_command(cmd_display_vlan_all,
+                           "ERROR: unable to get switch current config",
+                           channel)
+        return self._get_vlans_dict(self._get_output_list('VLAN ID:',
+                                                          channel=channel))
+
+    def _get_vlans_dict(self, vlan_buf_list):
         vlan_id = 0
         vlan_dict = {}
         ports_collect = False
         key = ''
 
-        self._set_system_view()
-        self._send_command(cmd_display_vlan_all,
-                           "ERROR: unable to get switch current config")
-        vlan_buf_list = self._get_output_list('VLAN ID:')
         for line in vlan_buf_list:
             # crud, skip it
             if line == ' ' or sys_prompt in line:
@@ -677,8 +1994,8 @@ class Comware_5_2(object):
             # get the ID
             m = re.search('^\sVLAN ID:\s(\d+)', line, re.DOTALL)
             if m:
-                vlan_id = m.group(1)
-                vlan_dict[vlan_id] = {}
+                vlan_id = intern(m.group(1))
+                vlan_dict[vlan_id] = VlanRecord()
                 next
 
             # get the rest
@@ -696,23 +2013,191 @@ class Comware_5_2(object):
 
             # if collecting ports, just split and append to array
             elif ports_collect:
-                ports_list = line.split()
+                ports_list = [intern(port) for port in line.split()]
                 vlan_dict[vlan_id][key] += ports_list
 
         return vlan_dict
 
-    def get_facts(self):
+    def _load_latency(self):
+        path = self._state_file('latency')
+        if not os.path.exists(path):
+            return {}
+        try:
+            store = open(path)
+            latency = json.load(store)
+            store.close()
+        except ValueError:
+            return {}
+        return latency
+
+    def _store_latency(self):
+        if not self.adaptive_timeouts:
+            return
+        path = self._state_file('latency')
+        store = open(path + '.tmp', 'w')
+        json.dump(self._latency, store)
+        store.close()
+        os.rename(path + '.tmp', path)
+
+    def _record_latency(self, metric, value):
+        if not self.adaptive_timeouts:
+            return
+        stats = self._latency.setdefault(metric, {'ewma': value,
+                                                  'samples': []})
+        stats['ewma'] += (value - stats['ewma']) * latency_weight
+        stats['samples'] = (stats['samples'] + [value])[-latency_samples:]
+
+    def _latency_percentile(self, metric, fraction):
+        samples = sorted(self._latency.get(metric, {}).get('samples', []))
+        if len(samples) < latency_samples_min:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    # what this host was seen to need, or timeout until enough was seen
+    def _learned_timeout(self, metric, timeout):
+        seen = self._latency_percentile(metric, 0.95)
+        if seen is None:
+            return timeout
+        return min(adaptive_timeout_max,
+                   max(adaptive_timeout_min, seen * latency_margin))
+
+    # a large display of this host at its slowest rate, bounded by
+    # command_timeout
+    def _learned_display_timeout(self):
+        size = self._latency_percentile('display_bytes', 0.95)
+        rate = self._latency_percentile('display_rate', 0.05)
+        if size is None or rate is None:
+            return self.command_timeout
+        return min(self.command_timeout,
+                   max(adaptive_timeout_min, size * latency_margin / rate))
+
+    def get_latency_stats(self):
+        stats = {}
+        for metric in self._latency:
+            stats[metric] = {'ewma': self._latency[metric]['ewma'],
+                             'p95': self._latency_percentile(metric, 0.95)}
+        return stats
+
+    def _load_cached_facts(self):
+        return cached_facts(self.host, self.facts_cache_ttl, self.state_dir)
+
+    def _store_cached_facts(self, facts):
+        if not self.facts_cache_ttl:
+            return
+        path = self._state_file('facts')
+        snapshot = open(path + '.tmp', 'w')
+        json.dump(facts_to_dict(facts), snapshot)
+        snapshot.close()
+        os.rename(path + '.tmp', path)
+
+    # a change makes the snapshot stale, also for later tasks that would
+    # not read the facts again themselves
+    def _drop_cached_facts(self):
+        path = os.path.join(self.state_dir, "%s.facts" % self.host)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # The port membership of facts['vlans'], indexed once per facts read.
+    # Predictions replace facts['vlans'] with a new dict, which is indexed
+    # again when asked for.
+    def _vlan_membership(self, facts):
+        if self._membership is None or \
+           self._membership[0] is not facts['vlans']:
+            self._membership = (facts['vlans'],
+                                VlanMembership(facts['vlans']))
+        return self._membership[1]
+
+    # Read-only callers and check mode may use a recent snapshot instead of
+    # asking the switch again. Every live read refreshes the snapshot.
+    def get_facts(self, cached=False):
+        if self._batch_facts is not None:
+            return self._batch_facts
+        if cached or self._check_mode:
+            facts = self._load_cached_facts()
+            if facts is not None:
+                return facts
+        facts = self._retry_read(self._read_facts)
+        self._store_cached_facts(facts)
+        self._store_latency()
+        return facts
+
+    def _read_facts(self):
         facts = {}
-#        if not self.module.params.get('gather_facts'):
+#        if not self.params.get('gather_facts'):
 #            return facts
-        developer_mode = self.module.params.get('developer-mode')
         self.dev_setup()
 #        facts['summary'] = self._get_summary()
-        facts['current_config'] = self._get_current_config()
-        facts['vlans'] = self._get_vlans()
-
+        if self.channels > 1:
+            # the configuration is listed on a second shell while this
+            # one lists the VLANs, which leaves it in system-view as usual
+            facts['current_config'], facts['vlans'] = \
+                self._run_parallel([self._get_current_config,
+                                    self._get_vlans])
+        else:
+            facts['current_config'] = self._get_current_config()
+            facts['vlans'] = self._get_vlans()
         return facts
 
+    # Extra shells on the already authenticated transport, each with
+    # paging disabled once. If the switch refuses more sessions, carry on
+    # with what there is.
+    def _get_channel_pool(self, size):
+        size = min(size, self.channels - 1)
+        while len(self._channel_pool) < size:
+            try:
+                channel = self.ssh.get_transport().open_session()
+                channel.settimeout(self.timeout)
+                channel.get_pty()
+                channel.invoke_shell()
+                self._send_command(cmd_disable_paging,
+                                   "ERROR: unable to disable paging", channel)
+                self._get_prompt_line(channel)
+            except Exception, e:
+                self.append_message("Unable to open another channel, %s %s. "
+                                    % (e.__class__, e))
+                self.channels = len(self._channel_pool) + 1
+                break
+            self._channel_pool.append(channel)
+        return self._channel_pool[:size]
+
+    # Run display jobs (methods taking a channel) at once. The last job
+    # runs on the main shell in this thread, the others on pool shells;
+    # jobs that don't get a shell of their own share one in turn. A job
+    # that fails raises, the first error is reported once all are done.
+    def _run_parallel(self, jobs):
+        pool = self._get_channel_pool(len(jobs) - 1)
+        results = [None] * len(jobs)
+        errors = []
+
+        def worker(channel, indexes):
+            try:
+                for index in indexes:
+                    results[index] = jobs[index](channel)
+            except Exception, e:
+                errors.append(e)
+
+        threads = []
+        self._parallel = True
+        try:
+            for offset, channel in enumerate(pool):
+                indexes = range(offset, len(jobs) - 1, len(pool))
+                thread = threading.Thread(target=worker,
+                                          args=(channel, indexes))
+                thread.start()
+                threads.append(thread)
+            if not pool:
+                worker(None, range(len(jobs) - 1))
+            worker(None, [len(jobs) - 1])
+            for thread in threads:
+                thread.join()
+        finally:
+            self._parallel = False
+        if errors:
+            if isinstance(errors[0], Comware_5_2_Error):
+                self.fail(str(errors[0]), errors[0].__class__)
+            raise errors[0]
+        return results
+
     def dev_setup(self):
         if self._developer_mode_set:
             self._developer_mode()
@@ -741,26 +2226,969 @@ class Comware_5_2(object):
 #          self._send_command(cmd_system_view," ERROR: unable to enter system-view")
         self._system_view = True
 
-    def reboot(self):
+    def reboot(self, wait=False, wait_timeout=reboot_wait_timeout,
+               save=False):
+        if self._check_mode:
+            self._changed = True
+            self.append_message("Switch would be rebooted. ")
+            return
         self.dev_setup()
         self._ensure_top_level_view()
         #prompt = self._get_prompt()
 
         self._send_command(cmd_reboot, "ERROR: Unable to reboot")
+        deadline = self._deadline(self.command_timeout)
         while True:
-            read_buf = self.channel.recv(1024)
+            read_buf = self._recv(self.channel, deadline,
+                                  "the reboot confirmation")
+            if not read_buf:
+                # the session is lost, the switch is on its way down
+                break
             read_buf = read_buf.replace("\r", "")
             if verify_save_current_conf in read_buf:
-                if self.module.params.get('save') is True:
+                if save is True:
                     self._send_command(cmd_yes)
                 else:
                     self._send_command(cmd_no)
-                    read_buf = self.channel.recv(1024)
+                    read_buf = self._recv(self.channel, deadline,
+                                          "the reboot confirmation")
+                    if not read_buf:
+                        break
                     read_buf = read_buf.replace("\r", "")
             if verify_reboot in read_buf:
                 self._send_command(cmd_yes)
                 break
-
-        self.append_message("Please wait for the switch to resume... ")
-        self.append_message("Rebooting.")
         self._changed = True
+
+        if not wait:
+            self.append_message("Please wait for the switch to resume... ")
+            self.append_message("Rebooting.")
+            return
+
+        started = time.time()
+        deadline = self._deadline(wait_timeout)
+        self._wait_session_lost(deadline)
+        lost = time.time()
+        self._wait_ssh_ready(deadline)
+        ssh_ready = time.time()
+        self._wait_cli_ready(deadline)
+        ready = time.time()
+
+        self._reboot_stats = {'session_lost': round(lost - started, 1),
+                              'ssh_ready': round(ssh_ready - started, 1),
+                              'downtime': round(ready - lost, 1),
+                              'time_to_ready': round(ready - started, 1)}
+        self.append_message("Switch rebooted, ready after %.1fs "
+                            "(downtime %.1fs). " %
+                            (self._reboot_stats['time_to_ready'],
+                             self._reboot_stats['downtime']))
+
+    def get_reboot_stats(self):
+        return self._reboot_stats
+
+    def _check_deadline(self, deadline, what):
+        if time.time() > deadline:
+            self.fail("ERROR: timed out waiting for %s after reboot" % what,
+                      Comware_5_2_Timeout)
+
+    # TCP connect and read the SSH identification string
+    def _probe_ssh(self, timeout):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout)
+        except (socket.error, socket.timeout):
+            return False
+        try:
+            sock.settimeout(timeout)
+            banner = sock.recv(256)
+        except (socket.error, socket.timeout):
+            banner = ''
+        sock.close()
+        return banner.startswith('SSH-')
+
+    # the session either gets closed or silently stops answering
+    def _wait_session_lost(self, deadline):
+        self.channel.settimeout(reboot_probe_base)
+        while True:
+            self._check_deadline(deadline, "the session to close")
+            try:
+                if not self.channel.recv(1024):
+                    break
+            except socket.timeout:
+                if not self._probe_ssh(reboot_probe_base):
+                    break
+            except Exception:
+                break
+        self.ssh.close()
+
+    def _wait_ssh_ready(self, deadline):
+        attempt = 0
+        while not self._probe_ssh(reboot_probe_cap):
+            self._check_deadline(deadline, "SSH")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    # SSH may answer before logins are accepted, retry until the CLI
+    # prompt shows up
+    def _wait_cli_ready(self, deadline):
+        attempt = 0
+        while True:
+            try:
+                self._connect()
+                self._developer_mode_set = False
+                self._get_prompt_line()
+                return
+            except Exception, e:
+                # the next attempt connects anew
+                self.close()
+                if time.time() > deadline:
+                    self.fail("ERROR: timed out waiting for the CLI after "
+                              "reboot %s %s" % (e.__class__, e),
+                              Comware_5_2_Timeout)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    # wait for a bare prompt at the end of the output
+    def _get_prompt_line(self, channel=None):
+        if channel is None:
+            channel = self.channel
+        channel.send("\n")
+        output_buf = ""
+        deadline = self._deadline(self.command_timeout)
+        while True:
+            read_buf = self._recv(channel, deadline, "the prompt",
+                                  self._read_timeout)
+            if not read_buf:
+                raise socket.error("session closed")
+            output_buf += read_buf.replace("\r", "")
+            prompt = output_buf.split("\n")[-1]
+            if re.match(prompt_re + '$', prompt):
+                return prompt
+
+
+class Comware_5_2_Vlan(Comware_5_2):
+    operation = 'vlan'
+
+    def dispatch(self):
+        facts = self._handle_vlan()
+        return facts
+
+    def _handle_vlan(self):
+        facts = self.get_facts()
+        vlan = {'vlan_id': self.params.get('vlan_id'),
+                'vlan_name': self.params.get('vlan_name'),
+                'tagged_port_type': self.params.get('tagged_port_type'),
+                'untagged_port_type':
+                self.params.get('untagged_port_type'),
+                'tagged_ports': self.params.get('tagged_ports'),
+                'untagged_ports': self.params.get('untagged_ports'),
+                'state': self.params.get('state'),
+                'interfaces': self.params.get('interfaces')}
+        if vlan['state'] == 'absent':
+            facts = self._delete_vlan(facts, vlan['vlan_id'])
+        else:
+            facts = self._save_vlan(facts, vlan)
+        # After adding or deleting vlan, save
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
+
+    def _vlan_changed(self, facts, vlan):
+        vlan_id = str(vlan['vlan_id'])
+        if vlan_id not in facts['vlans']:
+            return False
+        existing_vlan = facts['vlans'][vlan_id]
+        if vlan['vlan_name'] != existing_vlan['Name']:
+            return True
+        membership = self._vlan_membership(facts)
+        if not membership.same_ports(vlan_id, 'tagged', vlan['tagged_ports']):
+            return True
+        if not membership.same_ports(vlan_id, 'untagged',
+                                     vlan['untagged_ports']):
+            return True
+        return False
+
+    def _save_vlan(self, facts, vlan):
+        #self.dev_setup()
+        before = facts['vlans'].get(str(vlan['vlan_id']), {})
+        # if something has changed, best to delete then recreate
+        if self._vlan_changed(facts, vlan):
+            facts = self._delete_vlan(facts, vlan['vlan_id'])
+        self.set_changed(False)
+
+        # TODO: add error handling here
+        vlan_id = str(vlan['vlan_id'])
+
+        if vlan_id in facts['vlans']:
+            self.set_changed(False)
+            self.append_message("VLAN %s already exists\n" % vlan_id)
+            return facts
+
+        if vlan['tagged_ports'] and vlan['tagged_port_type'] == 'access':
+            self.fail("ERROR: tagged ports must be 'hybrid' or 'trunk'")
+        if vlan['untagged_ports'] and vlan['untagged_port_type'] == 'trunk':
+            self.fail("ERROR: untagged ports must be 'hybrid' or 'access'")
+
+        commands = ["vlan %s\n" % vlan_id]
+        # if user doesn't assign, name assigned by switch 000${vlan_id}
+        if vlan['vlan_name']:
+            commands.append("name %s\n" % vlan['vlan_name'])
+
+        for port in vlan['tagged_ports']:
+            port_type = vlan['tagged_port_type']
+            commands.append("interface %s\n" % port)
+            commands.append("port link-type %s\n" % port_type)
+            # could use else, but this is self-documenting
+            if port_type == 'hybrid':
+                commands.append("port hybrid vlan %s tagged\n" % vlan_id)
+            # trunk
+            else:
+                commands.append("port trunk permit vlan %s\n" % vlan_id)
+
+        for port in vlan['untagged_ports']:
+            port_type = vlan['untagged_port_type']
+            commands.append("interface %s\n" % port)
+            commands.append("port link-type %s\n" % port_type)
+            # could use else, but this is self-documenting
+            if port_type == 'hybrid':
+                commands.append("port hybrid vlan %s untagged\n" % vlan_id)
+            # access
+            else:
+                commands.append("port access vlan %s\n" % vlan_id)
+
+        # leave interface view
+        commands.append("quit\n")
+        self._push_config(commands,
+                          "ERROR: unable to configure VLAN %s" % vlan_id)
+
+        predicted_vlan = {'Name': vlan['vlan_name'] or
+                          "VLAN %04d" % vlan['vlan_id'],
+                          'Tagged_Ports': vlan['tagged_ports'],
+                          'Untagged_Ports': vlan['untagged_ports']}
+        self.set_diff(before, predicted_vlan)
+        if self.get_check_mode():
+            facts = self._predict_vlans(facts, vlan_id, predicted_vlan)
+            self.set_changed(True)
+            self.append_message("VLAN ID %s would be created\n" % vlan_id)
+            return facts
+
+        if self._defer_verify("Unable to create VLAN ID %s" % vlan_id,
+                              lambda facts: vlan_id in facts['vlans']):
+            self.set_changed(True)
+            self.append_message("VLAN ID %s created\n" % vlan_id)
+            return facts
+
+        # refresh facts
+        facts = self.get_facts()
+        if vlan_id in facts['vlans']:
+            self.set_changed(True)
+            self.append_message("VLAN ID %s created\n" % vlan_id)
+        else:
+            self.append_message("Unable to create VLAN ID %s\n" % vlan_id)
+
+        return facts
+
+    def _delete_vlan(self, facts, vlan_id):
+        self.set_changed(False)
+        if type(vlan_id) is not int:
+            self.fail("ERROR: 'id' provided is not numeric.")
+
+        # force to string
+        vlan_id = str(vlan_id)
+
+        if vlan_id not in facts['vlans']:
+            self.set_changed(False)
+            self.append_message("VLAN %s doesn't exist\n" % vlan_id)
+            return facts
+
+        self._push_config(["undo vlan %s\n" % vlan_id],
+                          "Unable to delete vlan %s" % vlan_id)
+
+        self.set_diff(facts['vlans'][vlan_id], {})
+        if self.get_check_mode():
+            facts = self._predict_vlans(facts, vlan_id, None)
+            self.set_changed(True)
+            self.append_message("VLAN ID %s would be deleted\n" % vlan_id)
+            return facts
+
+        if self._defer_verify("Unable to delete VLAN ID %s" % vlan_id,
+                              lambda facts: vlan_id not in facts['vlans']):
+            self.set_changed(True)
+            self.append_message("VLAN ID %s deleted\n" % vlan_id)
+            return facts
+
+        # refresh facts
+        facts = self.get_facts()
+
+        if vlan_id not in facts['vlans']:
+            self.set_changed(True)
+            self.append_message("VLAN ID %s deleted\n" % vlan_id)
+        else:
+            self.append_message("Unable to delete VLAN ID %s\n" % vlan_id)
+
+        return facts
+
+    # facts as they would be after the change, without touching the
+    # facts that were read
+    def _predict_vlans(self, facts, vlan_id, vlan):
+        facts = dict(facts)
+        facts['vlans'] = dict(facts['vlans'])
+        if vlan is None:
+            del facts['vlans'][vlan_id]
+        else:
+            facts['vlans'][vlan_id] = vlan
+        return facts
+
+
+class Comware_5_2_Port(Comware_5_2):
+    operation = 'port'
+
+    def dispatch(self):
+        facts = self._handle_port()
+        return facts
+
+    def _handle_port(self):
+        if self.params.get('gather_facts'):
+            facts = self.get_facts()
+            interfaces = facts['current_config']['interfaces']
+        else:
+            # only interfaces are looked at, the rest is never parsed
+            facts = {}
+            interfaces = self.get_config()['interfaces']
+        port = {'name': self.params.get('name'),
+                'vlans': self.params.get('vlans'),
+                'link_type': self.params.get('link_type'),
+                'tagged': self.params.get('tagged'),
+                'state': self.params.get('state')}
+        if port['name'] not in interfaces:
+            self.fail("ERROR: the port name specified doesn't exist\
+                      or is invalid!")
+
+        if self._port_changed(interfaces, port):
+            facts = self._save_port(facts, interfaces, port)
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
+
+    # which of the parsed 'vlan' lists port['vlans'] is compared with
+    def _tagging(self, port):
+        if port['link_type'] == 'trunk':
+            return 'tagged'
+        if port['link_type'] == 'access' or not port['tagged']:
+            return 'untagged'
+        return 'tagged'
+
+    def _link_type(self, current_port):
+        return current_port.get('port link-type', 'access')
+
+    # The switch leaves VLAN 1 out of the configuration where it is the
+    # default: an access port without a VLAN, a trunk unless 'undo port
+    # trunk permit vlan 1' and a hybrid port untagged unless 'undo port
+    # hybrid vlan 1' or VLAN 1 is tagged on it.
+    def _current_vlans(self, current_port, port):
+        port_vlans = current_port.get('vlan', {})
+        tagging = self._tagging(port)
+        vlans = port_vlans.get(tagging, {}).get(port['link_type'])
+        if port['link_type'] == 'access':
+            if vlans is None:
+                return VlanSet([1])
+            return VlanSet(vlans)
+        vlans = VlanSet(vlans or ())
+        if port['link_type'] == 'trunk':
+            if current_port.get('undo port trunk') != 'permit vlan 1':
+                vlans.update([1])
+        elif tagging == 'untagged':
+            if current_port.get('undo port hybrid') != 'vlan 1' and \
+               1 not in VlanSet(port_vlans.get('tagged', {})
+                                .get('hybrid') or ()):
+                vlans.update([1])
+        return vlans
+
+    def _port_changed(self, interfaces, port):
+        current_port = interfaces[port['name']]
+        if self._link_type(current_port) != port['link_type']:
+            return True
+        current_vlans = self._current_vlans(current_port, port)
+        if port['link_type'] == 'access':
+            return current_vlans != port['vlans']
+        # trunk and hybrid VLANs are added to those the port already has
+        return not VlanSet(port['vlans']).issubset(current_vlans)
+
+    def _save_port(self, facts, interfaces, port):
+        self.set_changed(False)
+        tagged = self._tagging(port)
+
+        if port['link_type'] == 'access' and port['tagged']:
+            self.fail("A link-type of 'access' cannot be tagged")
+        if port['link_type'] == 'access' and len(port['vlans']) > 1:
+            self.fail("A link-type of 'access' can only specify one vlan")
+
+        current_link_type = self._link_type(interfaces[port['name']])
+
+        commands = ["interface %s\n" % port['name']]
+        if current_link_type != port['link_type']:
+            # trunk and hybrid can only be switched between via access
+            if current_link_type != 'access' and \
+               port['link_type'] != 'access':
+                commands.append("port link-type access\n")
+            commands.append("port link-type %s\n" % port['link_type'])
+
+        # long lists go as ranges, over several commands if need be
+        if port['link_type'] == 'hybrid':
+            commands += vlan_range_commands("port hybrid vlan %s " +
+                                            tagged + "\n", port['vlans'])
+        elif port['link_type'] == 'trunk':
+            commands += vlan_range_commands("port trunk permit vlan %s\n",
+                                            port['vlans'])
+        # access
+        else:
+            commands.append("port access vlan %s\n" % port['vlans'][0])
+
+        # leave interface view
+        commands.append("quit\n")
+        self._push_config(commands, "ERROR: unable to configure port %s" %
+                          port['name'])
+
+        self.set_diff(interfaces[port['name']],
+                      {'port link-type': port['link_type'],
+                       'vlan': {tagged: {port['link_type']: port['vlans']}}})
+        if self.get_check_mode():
+            if facts:
+                facts = self._predict_port(facts, interfaces, port)
+            self.set_changed(True)
+            self.append_message("PORT %s would be saved\n" % port['name'])
+            return facts
+
+        if self._defer_verify(
+                "ERROR: port %s was not configured as requested" %
+                port['name'],
+                lambda facts: not self._port_changed(
+                    facts['current_config']['interfaces'], port)):
+            self.set_changed(True)
+            self.append_message("PORT %s saved\n" % port['name'])
+            return facts
+
+        # refresh facts, or read back just this interface
+        if self.params.get('gather_facts'):
+            facts = self.get_facts()
+            interfaces = facts['current_config']['interfaces']
+        else:
+            interfaces = self.get_interface_config(port['name'])['interfaces']
+        if port['name'] not in interfaces or \
+           self._port_changed(interfaces, port):
+            self.fail("ERROR: port %s was not configured as requested" %
+                      port['name'])
+        self.set_changed(True)
+        self.append_message("PORT %s saved\n" % port['name'])
+
+        return facts
+
+
+    # facts as they would be after the change, like _predict_vlans
+    def _predict_port(self, facts, interfaces, port):
+        current_port = interfaces[port['name']]
+        vlans = VlanSet(port['vlans'])
+        if port['link_type'] != 'access' and \
+           self._link_type(current_port) == port['link_type']:
+            vlans.update(self._current_vlans(current_port, port))
+        predicted_port = dict(current_port)
+        predicted_port['port link-type'] = port['link_type']
+        predicted_port['vlan'] = {self._tagging(port):
+                                  {port['link_type']: vlans}}
+        facts = dict(facts)
+        facts['current_config'] = dict(facts['current_config'])
+        facts['current_config']['interfaces'] = dict(interfaces)
+        facts['current_config']['interfaces'][port['name']] = predicted_port
+        return facts
+
+
+class Comware_5_2_User(Comware_5_2):
+    operation = 'user'
+
+    def dispatch(self):
+        facts = self._handle_user()
+        return facts
+
+    def _handle_user(self):
+        users = self.params.get('users')
+        if users:
+            users = [self._user_params(user) for user in users]
+        elif self.params.get('user_name'):
+            users = [self._user_params(self.params)]
+        else:
+            self.fail("ERROR: either user_name or users is required")
+
+        facts, local_users = self._get_local_users()
+        self.set_changed(False)
+        commands = []
+        for user in users:
+            commands += self._user_commands(local_users, user)
+        if commands:
+            facts = self._save_users(facts, local_users, users, commands)
+        else:
+            self.append_message("Users are unchanged\n")
+        # After adding or deleting users, save
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
+
+    def _user_params(self, params):
+        return {'name': params.get('user_name'),
+                'pass': params.get('user_pass'),
+                'state': params.get('state') or 'present',
+                'auth_level': params.get('auth_level'),
+                'services': params.get('services') or []}
+
+    # local users from the facts, or only the parsed local-user sections
+    # when no facts are to be returned
+    def _get_local_users(self):
+        if self.params.get('gather_facts'):
+            facts = self.get_facts()
+            return facts, facts['current_config']['local_user']
+        return {}, self.get_config()['local_user']
+
+    def _user_exists(self, local_users, name):
+        return name in local_users
+
+    def _user_changed(self, local_users, user):
+        return len(self._user_commands(local_users, user,
+                                       with_password=False)) > 0
+
+    # commands that make the switch's user what is asked for, none when
+    # it already is. A password can't be compared with the cipher the
+    # switch shows, update_password decides whether it is sent.
+    def _user_commands(self, local_users, user, with_password=True):
+        current_user = local_users.get(user['name'])
+        if user['state'] == 'absent':
+            if current_user is None:
+                return []
+            return ["undo local-user %s\n" % user['name']]
+
+        commands = []
+        if user['pass'] and with_password and \
+           (current_user is None or
+                self.params.get('update_password') == 'always'):
+            commands.append("password cipher %s\n" % user['pass'])
+        if current_user is None:
+            current_user = {}
+        if user['auth_level'] and \
+           current_user.get('authorization-attribute') != user['auth_level']:
+            commands.append("authorization-attribute %s\n" %
+                            user['auth_level'])
+        current_services = current_user.get('service_type', [])
+        for service in user['services']:
+            if service not in current_services:
+                commands.append("service-type %s\n" % service)
+        # services that are no longer asked for
+        if user['services']:
+            for service in current_services:
+                if service not in user['services']:
+                    commands.append("undo service-type %s\n" % service)
+
+        if not commands and user['name'] in local_users:
+            return []
+        return ["local-user %s\n" % user['name']] + commands + ["quit\n"]
+
+    def _save_users(self, facts, local_users, users, commands):
+        self._push_config(commands, "ERROR: unable to update users %s" %
+                          ", ".join(user['name'] for user in users))
+
+        before = {}
+        after = {}
+        for user in users:
+            if not self._user_commands(local_users, user):
+                continue
+            before[user['name']] = local_users.get(user['name'], {})
+            if user['state'] != 'absent':
+                after[user['name']] = {
+                    'authorization-attribute': user['auth_level'],
+                    'service_type': user['services']}
+        if len(users) == 1:
+            name = users[0]['name']
+            before = before.get(name, {})
+            after = after.get(name, {})
+        self.set_diff(before, after)
+
+        if self.get_check_mode():
+            self.set_changed(True)
+            for user in users:
+                if self._user_commands(local_users, user):
+                    self.append_message(self._user_message(user, True))
+            return facts
+
+        changed_users = [user for user in users
+                         if self._user_commands(local_users, user)]
+        if self._defer_verify(
+                "Unable to update the users %s" %
+                ", ".join(user['name'] for user in changed_users),
+                lambda facts: all(self._user_verified(
+                    facts['current_config']['local_user'], user)
+                    for user in changed_users)):
+            self.set_changed(True)
+            for user in changed_users:
+                self.append_message(self._user_message(user, False))
+            return facts
+
+        # one read to verify them all
+        facts, local_users = self._get_local_users()
+        self.set_changed(True)
+        for user in changed_users:
+            if not self._user_verified(local_users, user):
+                self.fail("Unable to update the user %s" % user['name'])
+            self.append_message(self._user_message(user, False))
+
+        return facts
+
+    def _user_verified(self, local_users, user):
+        if user['state'] == 'absent':
+            return not self._user_exists(local_users, user['name'])
+        return self._user_exists(local_users, user['name']) and \
+            not self._user_changed(local_users, user)
+
+    def _user_message(self, user, check_mode):
+        if user['state'] == 'absent':
+            if check_mode:
+                return "User %s would be deleted\n" % user['name']
+            return "User %s deleted\n" % user['name']
+        if check_mode:
+            return "The user %s would be updated\n" % user['name']
+        return "The user %s has been updated\n" % user['name']
+
+
+class Comware_5_2_User_int(Comware_5_2):
+    operation = 'user_interface'
+
+    def dispatch(self):
+        facts = self._handle_user_int()
+        return facts
+
+    def _handle_user_int(self):
+        user_int = {'uint_id': self.params.get('user_interface_id'),
+                'uint_type': self.params.get('user_interface_type'),
+                'auth': self.params.get('authentication_mode'),
+                'in_proto': self.params.get('in_protocol'),
+                'acl': self.params.get('acl')}
+#        if user['state'] == 'absent':
+#            facts = self._delete_user(facts, user['name'])
+#        else:
+#            facts = self._save_user(facts, user)
+        # After adding or deleting vlan, save
+        if user_int['acl'] is None or user_int['acl'] == 'skip':
+          user_int['acl'] = ''
+
+        facts = self._set_user_int(user_int)
+
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
+
+    # facts, and the user-interfaces of uint_type. Without facts to
+    # return only the configuration from the first user-interface on is
+    # read.
+    def _get_user_ints(self, user_int):
+        if self.params.get('gather_facts'):
+            facts = self.get_facts()
+            config = facts['current_config']
+        else:
+            facts = {}
+            config = self.get_config_begin('user-interface')
+        return facts, config['user_interfaces'].get(user_int['uint_type'], {})
+
+    # settings one user-interface needs, none when it is as asked
+    def _user_int_commands(self, current, user_int):
+        commands = []
+        if user_int['auth'] and \
+           user_int['auth'] not in current.get('authentication_mode', ''):
+            commands.append("authentication-mode %s\n" % user_int['auth'])
+        if user_int['in_proto'] and \
+           user_int['in_proto'] not in current.get('protocol_inbound', ''):
+            commands.append("protocol inbound %s\n" % user_int['in_proto'])
+        current_acl = current.get('acl', 'none')
+        if re.match('\s*[23]\d{3}\s*(inbound|outbound)', user_int['acl']):
+            if user_int['acl'] not in current_acl:
+                commands.append("acl %s\n" % user_int['acl'])
+        elif user_int['acl'] == 'none' and current_acl != 'none':
+            commands.append("undo acl %s\n" % current_acl)
+        return commands
+
+    # consecutive user-interfaces needing the same settings, as
+    # [first, last, commands], so each group is one 'user-interface
+    # vty 0 15'
+    def _user_int_groups(self, current, user_int):
+        groups = []
+        for uint in sorted(set(int(uint) for uint in user_int['uint_id'])):
+            commands = self._user_int_commands(current.get(str(uint), {}),
+                                               user_int)
+            if not commands:
+                continue
+            if groups and groups[-1][1] == uint - 1 and \
+               groups[-1][2] == commands:
+                groups[-1][1] = uint
+            else:
+                groups.append([uint, uint, commands])
+        return groups
+
+    def _set_user_int(self, user_int):
+        #self.dev_setup()
+        self.set_changed(False)
+
+        facts, current = self._get_user_ints(user_int)
+        groups = self._user_int_groups(current, user_int)
+        if not groups:
+            self.set_changed(False)
+            self.append_message("Change not needed. ")
+            return facts
+
+        commands = []
+        for first, last, settings in groups:
+            if first == last:
+                commands.append("user-interface %s %s\n" %
+                                (user_int['uint_type'], first))
+            else:
+                commands.append("user-interface %s %s %s\n" %
+                                (user_int['uint_type'], first, last))
+            commands += settings
+
+        # leave interface view
+        commands.append("quit\n")
+        self._push_config(commands, "ERROR: unable to configure user-interface %s" % user_int['uint_type'])
+
+        self.set_diff(dict((str(uint), current.get(str(uint), {})) for uint in user_int['uint_id']),
+                      dict((str(uint), {'authentication_mode': user_int['auth'],
+                                        'protocol_inbound': user_int['in_proto'],
+                                        'acl': user_int['acl']})
+                           for uint in user_int['uint_id']))
+        if self.get_check_mode():
+            self.set_changed(True)
+            self.append_message("Change needed. ")
+            return facts
+
+        if self._defer_verify(
+                "Failed to update user-interface %s configuration." %
+                user_int['uint_type'],
+                lambda facts: not self._user_int_groups(
+                    facts['current_config']['user_interfaces'].get(
+                        user_int['uint_type'], {}), user_int)):
+            self.set_changed(True)
+            return facts
+
+        # refresh, and verify all of them in one pass
+        facts, current = self._get_user_ints(user_int)
+        for first, last, settings in self._user_int_groups(current, user_int):
+            setting = settings[0].split()[0]
+            if setting == 'undo':
+                setting = 'acl'
+            elif setting == 'protocol':
+                setting = 'protocol inbound'
+            self.fail("Failed to update user-interface %s %s %s configuration." % (user_int['uint_type'], first, setting))
+            return facts
+
+        self.set_changed(True)
+
+        return facts
+
+
+class Comware_5_2_Hostname(Comware_5_2):
+    operation = 'hostname'
+
+    def dispatch(self):
+        facts = self._handle_hostname()
+        return facts
+
+    def _handle_hostname(self):
+        facts, current_hostname = self._get_hostname()
+        hostname = self.params.get('hostname')
+        if current_hostname != hostname:
+            facts = self._set_hostname(facts, current_hostname, hostname)
+        else:
+             self.append_message("The hostname %s was already set.\n" % hostname)
+        # After adding or deleting vlan, save
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
+
+    # facts, and the hostname. Without facts to return only the sysname
+    # line of the configuration is read.
+    def _get_hostname(self):
+        if self.params.get('gather_facts'):
+            facts = self.get_facts()
+            return facts, facts['current_config']['sysname']
+        return {}, self.get_hostname()
+
+    def _set_hostname(self, facts, current_hostname, hostname):
+        #self.dev_setup()
+        self.set_changed(False)
+
+        self._push_config(["sysname %s\n" % hostname],
+                          "ERROR: unable to set the hostname")
+        # leave interface view
+#        self._quit()
+        self.set_diff({'sysname': current_hostname},
+                      {'sysname': hostname})
+        if self.get_check_mode():
+            self.set_changed(True)
+            self.append_message("The hostname %s would be set.\n" %
+                                hostname)
+            return facts
+
+        if self._defer_verify(
+                "Unable to update the hostname %s." % hostname,
+                lambda facts: facts['current_config']['sysname'] == hostname):
+            self.set_changed(True)
+            self.append_message("The hostname %s has been updated.\n" %
+                                hostname)
+            return facts
+
+        # refresh facts
+        facts, current_hostname = self._get_hostname()
+        if hostname == current_hostname:
+            self.set_changed(True)
+            self.append_message("The hostname %s has been updated.\n" %
+                                hostname)
+        else:
+            self.append_message("Unable to update the hostname %s.\n" %
+                                hostname)
+
+        return facts
+
+
+# what the modules default to for the options of each operation
+operation_defaults = {'vlan': {'tagged_port_type': 'trunk',
+                               'untagged_port_type': 'access',
+                               'tagged_ports': [],
+                               'untagged_ports': [],
+                               'state': 'present'},
+                      'port': {'link_type': 'access',
+                               'tagged': False,
+                               'state': 'present'},
+                      'user': {'services': [],
+                               'update_password': 'always',
+                               'state': 'present'},
+                      'user_interface': {},
+                      'hostname': {}}
+batch_lists = ['tagged_ports', 'untagged_ports', 'vlans', 'services',
+               'user_interface_id']
+
+
+# The operations of the vlan, port, user, user_interface and hostname
+# modules run one after the other over one session. Facts are read once
+# before them all, and once after to verify whatever they changed. The
+# configuration is saved at most once, at the end. An operation on an
+# object an earlier one changed has the facts read, and the changes so
+# far verified, first. In check mode it works from the predicted facts.
+class Comware_5_2_Batch(Comware_5_2_Vlan,
+                        Comware_5_2_Port,
+                        Comware_5_2_User,
+                        Comware_5_2_User_int,
+                        Comware_5_2_Hostname):
+    operation = 'batch'
+    batch_operations = {'vlan': Comware_5_2_Vlan._handle_vlan,
+                        'port': Comware_5_2_Port._handle_port,
+                        'user': Comware_5_2_User._handle_user,
+                        'user_interface':
+                        Comware_5_2_User_int._handle_user_int,
+                        'hostname': Comware_5_2_Hostname._handle_hostname}
+
+    def dispatch(self):
+        facts = self._handle_batch()
+        return facts
+
+    def _task_params(self, task):
+        if task.get('op') not in self.batch_operations:
+            self.fail("ERROR: unknown batch operation %s, expected one of %s"
+                      % (task.get('op'),
+                         ", ".join(sorted(self.batch_operations))))
+        params = dict(self.params)
+        params.update(operation_defaults[task['op']])
+        params.update(task)
+        for key in batch_lists:
+            if isinstance(params.get(key), basestring):
+                params[key] = params[key].split(',')
+        if params.get('vlan_id') is not None:
+            params['vlan_id'] = int(params['vlan_id'])
+        # the batch saves, and the facts are what the operations work on
+        params['save'] = False
+        params['gather_facts'] = True
+        return params
+
+    # the configuration objects an operation looks at and may change
+    def _task_objects(self, params):
+        op = params['op']
+        if op == 'vlan':
+            return set([('vlans', str(params.get('vlan_id')))] +
+                       [('interfaces', port) for port in
+                        (params.get('tagged_ports') or []) +
+                        (params.get('untagged_ports') or [])])
+        if op == 'port':
+            return set([('interfaces', params.get('name'))] +
+                       [('vlans', str(vlan_id))
+                        for vlan_id in VlanSet(params.get('vlans') or ())])
+        if op == 'user':
+            users = params.get('users') or [params]
+            return set(('local_user', user.get('user_name'))
+                       for user in users)
+        if op == 'user_interface':
+            return set([('user_interfaces',
+                         params.get('user_interface_type'))])
+        return set([('sysname', None)])
+
+    # read the facts and run the checks kept so far against them
+    def _run_deferred_checks(self):
+        self._batch_facts = None
+        facts = self.get_facts()
+        for msg, check in self._deferred_checks:
+            if not check(facts):
+                self.fail(msg)
+        self._deferred_checks = []
+        return facts
+
+    def _handle_batch(self):
+        batch_params = self.params
+        tasks = [self._task_params(task)
+                 for task in batch_params.get('tasks') or []]
+
+        self._batch_facts = self.get_facts()
+        self._deferred_checks = []
+        changed = False
+        diffs = []
+        # objects changed since the facts were read
+        changed_objects = set()
+        try:
+            for params in tasks:
+                objects = self._task_objects(params)
+                if objects & changed_objects:
+                    # an earlier operation changed what this one works
+                    # on: read again, and verify what was done so far
+                    self._batch_facts = self._run_deferred_checks()
+                    changed_objects = set()
+                self.params = params
+                self._diff = {}
+                self.set_changed(False)
+                facts = self.batch_operations[params['op']](self)
+                if self.get_changed():
+                    changed = True
+                    if self.get_check_mode():
+                        # nothing to read back, go on from the prediction
+                        self._batch_facts = facts
+                    else:
+                        changed_objects |= objects
+                if self._diff:
+                    diffs.append(self._diff)
+        finally:
+            self.params = batch_params
+            facts = self._batch_facts
+            self._batch_facts = None
+
+        if self._deferred_checks:
+            facts = self._run_deferred_checks()
+        self._deferred_checks = None
+        self.set_changed(changed)
+        self._diff = diffs
+        if self.params.get('save') is True:
+            self.save()
+
+        return facts
@@ -0,0 +1,1038 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from comware_5_2 import Comware_5_2, Comware_5_2_Batch, Comware_5_2_Error, \
+    Comware_5_2_Hostname, Comware_5_2_Port, Comware_5_2_Timeout, \
+    Comware_5_2_Unreachable, Comware_5_2_User, Comware_5_2_User_int, \
+    Comware_5_2_Vlan, ComwareConfig, VlanMembership, VlanSet, facts_to_dict, \
+    iter_config_events, mark_unreachable, preflight, vlan_range_commands
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+
+sample_config = ["#",
+                 " sysname HP5500",
+                 "#",
+                 "vlan 1",
+                 "#",
+                 "vlan 11",
+                 " name users",
+                 "#",
+                 "interface GigabitEthernet1/0/1",
+                 " port link-type trunk",
+                 " port trunk permit vlan 11",
+                 "#",
+                 "local-user admin",
+                 " password cipher secret",
+                 " authorization-attribute level 3",
+                 " service-type ssh",
+                 "local-user bob",
+                 " password cipher other",
+                 " service-type telnet",
+                 "#",
+                 "return"]
+
+
+class VlanSetTest(unittest.TestCase):
+    def test_update(self):
+        vlans = VlanSet(['1', 5, '10 to 12', '20-21'])
+        self.assertEqual(list(vlans), [1, 5, 10, 11, 12, 20, 21])
+        vlans.update("30 to 31 40")
+        self.assertEqual(len(vlans), 10)
+        self.assertTrue(40 in vlans)
+        self.assertFalse('39' in vlans)
+
+    def test_all(self):
+        vlans = VlanSet('all')
+        self.assertEqual(len(vlans), 4094)
+        self.assertEqual(vlans.ranges(), ['1 to 4094'])
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, VlanSet, [4095])
+
+    def test_ranges(self):
+        self.assertEqual(VlanSet([3, 1, 2, 7, 9, 10]).ranges(),
+                         ['1 to 3', '7', '9 to 10'])
+
+    def test_compare(self):
+        self.assertEqual(VlanSet('1 to 3'), [1, 2, 3])
+        self.assertNotEqual(VlanSet('1 to 3'), [1, 2])
+        self.assertTrue(VlanSet([2]).issubset('1 to 3'))
+        self.assertFalse(VlanSet([4]).issubset('1 to 3'))
+
+    def test_facts_to_dict(self):
+        facts = {'ports': [{'vlans': VlanSet('all')}]}
+        self.assertEqual(facts_to_dict(facts),
+                         {'ports': [{'vlans': ['1 to 4094']}]})
+
+
+class VlanRangeCommandsTest(unittest.TestCase):
+    def test_one_command(self):
+        self.assertEqual(vlan_range_commands("port trunk permit vlan %s\n",
+                                             [1, 2, 3, 5]),
+                         ["port trunk permit vlan 1 to 3 5\n"])
+
+    def test_split(self):
+        commands = vlan_range_commands("%s", range(1, 50, 2))
+        self.assertEqual(len(commands), 3)
+        self.assertEqual(commands[0].split(),
+                         [str(vlan_id) for vlan_id in range(1, 20, 2)])
+        self.assertEqual(commands[2], "41 43 45 47 49")
+
+
+class VlanMembershipTest(unittest.TestCase):
+    def setUp(self):
+        self.membership = VlanMembership(
+            {'1': {'Tagged_Ports': 'none',
+                   'Untagged_Ports': ['GigabitEthernet1/0/1']},
+             '11': {'Tagged_Ports': ['GigabitEthernet1/0/2',
+                                     'GigabitEthernet1/0/3'],
+                    'Untagged_Ports': 'none'}})
+
+    def test_ports(self):
+        self.assertTrue(self.membership.has_port(11, 'GigabitEthernet1/0/2'))
+        self.assertFalse(self.membership.has_port(
+            11, 'GigabitEthernet1/0/2', 'untagged'))
+        self.assertFalse(self.membership.has_port(1, 'GigabitEthernet1/0/9'))
+        self.assertEqual(sorted(self.membership.ports('11', 'tagged')),
+                         ['GigabitEthernet1/0/2', 'GigabitEthernet1/0/3'])
+
+    def test_vlans(self):
+        self.assertEqual(self.membership.vlans('GigabitEthernet1/0/2'), [11])
+        self.assertEqual(self.membership.vlans('GigabitEthernet1/0/1',
+                                               'tagged'), [])
+
+    def test_json_port_names(self):
+        vlans = json.loads(json.dumps({'11': {'Tagged_Ports':
+                                              ['GigabitEthernet1/0/2'],
+                                              'Untagged_Ports': 'none'}}))
+        membership = VlanMembership(vlans)
+        self.assertTrue(membership.has_port(11, 'GigabitEthernet1/0/2'))
+        self.assertTrue(membership.same_ports(11, 'tagged',
+                                              [u'GigabitEthernet1/0/2']))
+
+    def test_vlan_changed_on_snapshot_facts(self):
+        switch = Comware_5_2_Vlan.__new__(Comware_5_2_Vlan)
+        switch._membership = None
+        facts = json.loads(json.dumps(
+            {'vlans': {'11': {'Name': 'users',
+                              'Tagged_Ports': ['GigabitEthernet1/0/2'],
+                              'Untagged_Ports': 'none'}}}))
+        vlan = {'vlan_id': 11, 'vlan_name': 'users',
+                'tagged_ports': ['GigabitEthernet1/0/2'],
+                'untagged_ports': []}
+        self.assertFalse(switch._vlan_changed(facts, vlan))
+        vlan['untagged_ports'] = ['GigabitEthernet1/0/3']
+        self.assertTrue(switch._vlan_changed(facts, vlan))
+
+    def test_diff(self):
+        added, removed = self.membership.diff(
+            11, 'tagged', ['GigabitEthernet1/0/3', 'GigabitEthernet1/0/4'])
+        self.assertEqual(added, ['GigabitEthernet1/0/4'])
+        self.assertEqual(removed, ['GigabitEthernet1/0/2'])
+        self.assertTrue(self.membership.same_ports(
+            11, 'tagged', ['GigabitEthernet1/0/3', 'GigabitEthernet1/0/2']))
+
+
+class ComwareConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.config = ComwareConfig(sample_config)
+
+    def test_users_of_one_section(self):
+        self.assertEqual(list(self.config['local_user']), ['admin', 'bob'])
+        self.assertEqual(self.config['local_user']['bob']['password'],
+                         'cipher other')
+
+    def test_same_as_full_parser(self):
+        switch = Comware_5_2.__new__(Comware_5_2)
+        self.assertEqual(self.config.to_dict(),
+                         switch._get_config_dict(sample_config))
+
+    def test_lookup(self):
+        self.assertTrue('GigabitEthernet1/0/1' in self.config['interfaces'])
+        self.assertFalse('GigabitEthernet1/0/2' in self.config['interfaces'])
+        self.assertEqual(self.config['sysname'], 'HP5500')
+
+
+class ConfigEventsTest(unittest.TestCase):
+    def test_events(self):
+        events = list(iter_config_events(iter(sample_config)))
+        self.assertEqual(events[:4], [
+            ('global', None, 'sysname', 'HP5500'),
+            ('vlans', '1', None, None),
+            ('vlans', '11', 'name', 'users'),
+            ('interfaces', 'GigabitEthernet1/0/1', 'port link-type',
+             'trunk')])
+        self.assertTrue(('local_user', 'bob', 'service_type', ['telnet'])
+                        in events)
+
+    def test_same_as_full_parser(self):
+        config_dict = Comware_5_2.__new__(Comware_5_2)._get_config_dict(
+            sample_config)
+        users = {}
+        for section, object_id, key, value in \
+                iter_config_events(iter(sample_config)):
+            if section == 'local_user':
+                users.setdefault(object_id, {})[key] = value
+        self.assertEqual(users, config_dict['local_user'])
+
+    # one stream over several configs
+    def test_concatenated(self):
+        other = [line.replace("HP5500", "HP5500-2")
+                 for line in sample_config]
+        sysnames = [value for section, object_id, key, value
+                    in iter_config_events(sample_config + other)
+                    if key == 'sysname']
+        self.assertEqual(sysnames, ['HP5500', 'HP5500-2'])
+
+
+class StreamingParseTest(unittest.TestCase):
+    # the sample as the switch prints it, read chunk bytes at a time
+    def switch(self, chunk):
+        switch = Comware_5_2(host='sw1')
+        config = "#\n version 5.20, Release 2220\n" + \
+            "\n".join(sample_config[1:])
+        switch.channel = ScriptChannel(
+            {'display current-configuration': config}, chunk=chunk)
+        return switch
+
+    def test_same_as_full_parser(self):
+        expected = Comware_5_2.__new__(Comware_5_2)._get_config_dict(
+            sample_config)
+        for chunk in [1, 5, 16, 1024]:
+            switch = self.switch(chunk)
+            self.assertEqual(switch._get_current_config(switch.channel),
+                             expected)
+
+    def test_lines(self):
+        switch = self.switch(3)
+        switch._run_current_config(switch.channel)
+        lines = list(switch._iter_config_lines(switch.channel))
+        self.assertEqual(lines[-2:], ["#", "return"])
+        self.assertTrue("local-user bob" in lines)
+
+
+# hands out canned output, all of it in one read
+class StubChannel(object):
+    def __init__(self, output):
+        self.output = output
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv_ready(self):
+        return False
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        output, self.output = self.output, ""
+        return output
+
+
+# output of a switch question, it waits for the answer without a prompt
+class Ask(str):
+    pass
+
+
+# A switch shell: each command line sent is echoed, followed by its
+# response and the prompt. Output is handed out chunk bytes at a time,
+# and when there is none a read times out. A list of responses is used
+# in turn, its last one from then on.
+class ScriptChannel(object):
+    def __init__(self, responses=None, prompt="[HP]", chunk=16):
+        self.responses = responses or {}
+        self.prompt = prompt
+        self.chunk = chunk
+        self.sent = []
+        self.output = ""
+
+    def send(self, data):
+        self.sent.append(data)
+        for command in data.split("\n")[:-1]:
+            response = self.responses.get(command, "")
+            if isinstance(response, list):
+                if len(response) > 1:
+                    response = response.pop(0)
+                else:
+                    response = response[0]
+            self.output += command + "\r\n"
+            if isinstance(response, Ask):
+                self.output += response
+                continue
+            if response:
+                self.output += response.replace("\n", "\r\n") + "\r\n"
+            self.output += self.prompt
+
+    def recv_ready(self):
+        return len(self.output) > 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        if not self.output:
+            raise socket.timeout()
+        output = self.output[:min(size, self.chunk)]
+        self.output = self.output[len(output):]
+        return output
+
+    def close(self):
+        pass
+
+
+saved_config = "#\n version 5.20, Release 2220\n sysname HP\n#\nreturn"
+save_responses = {
+    'save': Ask("The current configuration will be written to the device. "
+                "Are you sure? [Y/N]:"),
+    'Y': Ask("Please input the file name(*.cfg)[flash:/startup.cfg]\r\n"
+             "(To leave the existing filename unchanged, press the enter "
+             "key):"),
+    'flash:/startup.cfg': "Validating file. Please wait....\n"
+                          "Configuration is saved to device successfully.",
+    'display current-configuration': saved_config,
+    'display saved-configuration': saved_config}
+
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def switch(self, responses, **kwargs):
+        switch = Comware_5_2(host='sw1', state_dir=self.state_dir,
+                             startup_cfg='startup.cfg', **kwargs)
+        switch.channel = ScriptChannel(responses)
+        switch._paging_disabled = True
+        return switch
+
+    def test_skipped_when_saved(self):
+        switch = self.switch(save_responses)
+        self.assertFalse(switch.save())
+        self.assertTrue("save skipped" in switch.get_message())
+        self.assertEqual(switch.channel.sent,
+                         ["display current-configuration\n",
+                          "display saved-configuration\n"])
+
+    def test_saved_when_changed(self):
+        responses = dict(save_responses)
+        responses['display saved-configuration'] = \
+            saved_config.replace("HP", "HP-old")
+        switch = self.switch(responses)
+        self.assertTrue(switch.save())
+        self.assertEqual(switch.channel.sent[2:],
+                         ["save\n", "Y\n", "flash:/startup.cfg\n"])
+        self.assertFalse(switch.get_dirty())
+
+    def test_saved_after_change(self):
+        switch = self.switch(save_responses)
+        switch._dirty = True
+        self.assertTrue(switch.save())
+        self.assertEqual(switch.channel.sent,
+                         ["save\n", "Y\n", "flash:/startup.cfg\n"])
+
+    def test_deferred(self):
+        switch = self.switch(save_responses, defer_save=True)
+        self.assertFalse(switch.save())
+        self.assertEqual(switch.get_pending_save(), [])
+        switch._dirty = True
+        switch.append_message("VLAN ID 10 created\n")
+        self.assertFalse(switch.save())
+        self.assertEqual(switch.channel.sent, [])
+        self.assertEqual(switch.get_pending_save(),
+                         ["Comware_5_2: VLAN ID 10 created"])
+
+        # one save for all that was deferred
+        switch = self.switch(save_responses)
+        self.assertEqual(switch.save_pending(),
+                         ["Comware_5_2: VLAN ID 10 created"])
+        self.assertTrue(switch.get_changed())
+        self.assertEqual(switch.channel.sent,
+                         ["save\n", "Y\n", "flash:/startup.cfg\n"])
+        self.assertEqual(switch.get_pending_save(), [])
+
+    def test_switch_error(self):
+        responses = dict(save_responses)
+        responses['flash:/startup.cfg'] = " % The file system is full."
+        switch = self.switch(responses)
+        switch._dirty = True
+        try:
+            switch.save()
+        except Comware_5_2_Error, e:
+            self.assertTrue("The file system is full" in str(e))
+        else:
+            self.fail("the error was not reported")
+
+
+class StubClient(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RebootTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.switch = Comware_5_2(host='sw1', state_dir=self.state_dir)
+        self.switch._paging_disabled = True
+        self.switch._is_system_view = lambda: False
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_session_lost_while_confirming(self):
+        self.switch.ssh = StubClient()
+        self.switch.channel = StubChannel("")
+        started = time.time()
+        self.switch.reboot()
+        self.assertTrue(time.time() - started < 1)
+        self.assertTrue(self.switch.get_changed())
+        self.assertEqual(self.switch.channel.sent, ["reboot\n"])
+
+    def test_wait_phases(self):
+        switch = self.switch
+        client = switch.ssh = StubClient()
+        channel = switch.channel = StubChannel(
+            "This command will reboot the device. Continue? [Y/N]:")
+        switch._probe_ssh = lambda timeout: True
+        clients = []
+
+        # the first login gets no CLI yet, the second one a prompt
+        def connect():
+            clients.append(StubClient())
+            switch.ssh = clients[-1]
+            switch.channel = StubChannel(len(clients) > 1 and "\r\n<HP>"
+                                         or "")
+        switch._connect = connect
+
+        switch.reboot(wait=True)
+        self.assertEqual(channel.sent, ["reboot\n", "Y\n"])
+        self.assertTrue(client.closed)
+        self.assertEqual([c.closed for c in clients], [True, False])
+        self.assertEqual(sorted(switch.get_reboot_stats()),
+                         ['downtime', 'session_lost', 'ssh_ready',
+                          'time_to_ready'])
+
+
+class SendCommandsTest(unittest.TestCase):
+    def test_error_of_command_in_flight(self):
+        switch = Comware_5_2(host='sw1')
+        switch.channel = StubChannel(
+            "vlan 10\r\n[HP]bad\r\n"
+            " % Unrecognized command found at '^' position.\r\n"
+            "[HP]name x\r\n[HP]")
+        switch._send_window = 8
+        try:
+            switch._send_commands(["vlan 10\n", "bad\n", "name x\n"])
+        except Comware_5_2_Error, e:
+            self.assertTrue("command bad failed" in str(e))
+        else:
+            self.fail("the error was not reported")
+
+
+# counts the results a module would print
+class StubModule(object):
+    params = {}
+    check_mode = False
+
+    def __init__(self):
+        self.failures = []
+
+    def fail_json(self, **kwargs):
+        self.failures.append(kwargs)
+        raise SystemExit(1)
+
+
+class RunParallelTest(unittest.TestCase):
+    def test_fails_once(self):
+        module = StubModule()
+        switch = Comware_5_2(module, host='sw1', channels=3)
+        switch._get_channel_pool = lambda size: [StubChannel(""),
+                                                 StubChannel("")]
+
+        def job(channel):
+            switch.fail("ERROR: unable to display")
+        self.assertRaises(SystemExit, switch._run_parallel, [job] * 3)
+        self.assertEqual(module.failures,
+                         [{'msg': "ERROR: unable to display"}])
+
+    def test_results(self):
+        switch = Comware_5_2(host='sw1', channels=2)
+        switch._get_channel_pool = lambda size: [StubChannel("")]
+        self.assertEqual(switch._run_parallel([lambda channel: 1,
+                                               lambda channel: 2]), [1, 2])
+
+
+class PortVlansTest(unittest.TestCase):
+    def setUp(self):
+        switch = Comware_5_2.__new__(Comware_5_2)
+        self.interfaces = switch._get_config_dict([
+            "interface GigabitEthernet1/0/1",
+            " port link-type trunk",
+            " port trunk permit vlan 11",
+            "#",
+            "interface GigabitEthernet1/0/2",
+            " port link-type trunk",
+            " undo port trunk permit vlan 1",
+            " port trunk permit vlan 11",
+            "#",
+            "interface GigabitEthernet1/0/3",
+            " port link-type hybrid",
+            "#"])['interfaces']
+        self.port = Comware_5_2_Port(host='sw1')
+
+    def changed(self, name, link_type, vlans):
+        return self.port._port_changed(self.interfaces,
+                                       {'name': name,
+                                        'link_type': link_type,
+                                        'vlans': vlans,
+                                        'tagged': False})
+
+    def test_trunk_permits_vlan_1(self):
+        self.assertFalse(self.changed('GigabitEthernet1/0/1', 'trunk',
+                                      [1, 11]))
+        self.assertTrue(self.changed('GigabitEthernet1/0/2', 'trunk', [1]))
+
+    def test_hybrid_untagged_vlan_1(self):
+        self.assertFalse(self.changed('GigabitEthernet1/0/3', 'hybrid', [1]))
+
+    def test_trunk_permits_vlans_not_created(self):
+        # 'display vlan all' leaves out VLAN 100, the configuration not
+        self.interfaces['GigabitEthernet1/0/1']['vlan']['tagged']['trunk'] \
+            .update([100])
+        self.assertFalse(self.changed('GigabitEthernet1/0/1', 'trunk',
+                                      ['11', '100']))
+
+
+class UserCommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.switch = Comware_5_2_User(host='sw1')
+        self.users = ComwareConfig(sample_config)['local_user']
+
+    def commands(self, **params):
+        params.setdefault('user_name', 'bob')
+        return self.switch._user_commands(self.users,
+                                          self.switch._user_params(params))
+
+    def test_add(self):
+        self.assertEqual(self.commands(user_name='carol', user_pass='x',
+                                       auth_level='level 1',
+                                       services=['ssh']),
+                         ["local-user carol\n", "password cipher x\n",
+                          "authorization-attribute level 1\n",
+                          "service-type ssh\n", "quit\n"])
+
+    def test_unchanged(self):
+        self.assertEqual(self.commands(user_pass='x', services=['telnet']),
+                         [])
+        self.switch.params = {'update_password': 'always'}
+        self.assertEqual(self.commands(user_pass='x', services=['telnet']),
+                         ["local-user bob\n", "password cipher x\n",
+                          "quit\n"])
+
+    def test_services(self):
+        self.assertEqual(self.commands(services=['ssh']),
+                         ["local-user bob\n", "service-type ssh\n",
+                          "undo service-type telnet\n", "quit\n"])
+
+    def test_absent(self):
+        self.assertEqual(self.commands(state='absent'),
+                         ["undo local-user bob\n"])
+        self.assertEqual(self.commands(user_name='carol', state='absent'),
+                         [])
+
+
+user_int_config = ["#",
+                   "user-interface vty 0 4",
+                   " authentication-mode scheme",
+                   " protocol inbound ssh",
+                   "user-interface vty 5 15",
+                   " authentication-mode password",
+                   "#",
+                   "return"]
+
+
+class UserIntGroupsTest(unittest.TestCase):
+    def setUp(self):
+        self.switch = Comware_5_2_User_int(host='sw1')
+        self.current = ComwareConfig(
+            user_int_config)['user_interfaces']['vty']
+
+    def groups(self, uint_ids, auth='scheme', acl=''):
+        return self.switch._user_int_groups(
+            self.current, {'uint_id': uint_ids, 'uint_type': 'vty',
+                           'auth': auth, 'in_proto': 'ssh', 'acl': acl})
+
+    def test_one_group(self):
+        self.assertEqual(self.groups(range(16)),
+                         [[5, 15, ["authentication-mode scheme\n",
+                                   "protocol inbound ssh\n"]]])
+
+    def test_gaps(self):
+        self.assertEqual([group[:2] for group in
+                          self.groups(['5', '6', '9', '7'])],
+                         [[5, 7], [9, 9]])
+
+    def test_different_settings(self):
+        self.assertEqual(self.groups(range(3, 7), acl='2000 inbound'),
+                         [[3, 4, ["acl 2000 inbound\n"]],
+                          [5, 6, ["authentication-mode scheme\n",
+                                  "protocol inbound ssh\n",
+                                  "acl 2000 inbound\n"]]])
+
+
+class HostnameTest(unittest.TestCase):
+    def switch(self, sysname, prompt="[HP5500]"):
+        switch = Comware_5_2_Hostname(host='sw1', check_mode=True)
+        switch.channel = ScriptChannel(
+            {'display current-configuration | include sysname': sysname},
+            prompt=prompt)
+        switch._paging_disabled = True
+        return switch
+
+    def test_one_line_read(self):
+        switch = self.switch(" sysname HP5500")
+        self.assertEqual(switch.get_hostname(), 'HP5500')
+        self.assertFalse("display current-configuration\n" in
+                         switch.channel.sent)
+
+    def test_default_name(self):
+        switch = self.switch("", prompt="[H3C]")
+        self.assertEqual(switch.get_hostname(), 'H3C')
+
+    def test_set(self):
+        switch = self.switch(" sysname HP5500")
+        result = switch.run({'hostname': 'core1', 'gather_facts': False})
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['commands'], ['sysname core1'])
+        self.assertEqual(result['diff'], {'before': {'sysname': 'HP5500'},
+                                          'after': {'sysname': 'core1'}})
+        # check mode only read the switch
+        self.assertFalse("sysname core1\n" in switch.channel.sent)
+
+    def test_unchanged(self):
+        switch = self.switch(" sysname HP5500")
+        result = switch.run({'hostname': 'HP5500', 'gather_facts': False})
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['commands'], [])
+
+
+class BatchTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.switch = Comware_5_2_Batch(host='sw1')
+        self.switch.params = {'save': True, 'timeout': 30}
+
+    def test_params(self):
+        params = self.switch._task_params(
+            {'op': 'vlan', 'vlan_id': '12',
+             'tagged_ports': 'GigabitEthernet1/0/1,GigabitEthernet1/0/2'})
+        self.assertEqual(params['vlan_id'], 12)
+        self.assertEqual(params['tagged_ports'],
+                         ['GigabitEthernet1/0/1', 'GigabitEthernet1/0/2'])
+        self.assertEqual(params['untagged_port_type'], 'access')
+        self.assertEqual(params['timeout'], 30)
+        # saved once, at the end of the batch
+        self.assertFalse(params['save'])
+
+    def test_unknown_operation(self):
+        self.assertRaises(Comware_5_2_Error, self.switch._task_params,
+                          {'op': 'acl'})
+
+    def test_objects(self):
+        vlan = self.switch._task_params(
+            {'op': 'vlan', 'vlan_id': 12,
+             'untagged_ports': ['GigabitEthernet1/0/2']})
+        port = self.switch._task_params(
+            {'op': 'port', 'name': 'GigabitEthernet1/0/1', 'vlans': '11-12'})
+        self.assertEqual(self.switch._task_objects(vlan),
+                         set([('vlans', '12'),
+                              ('interfaces', 'GigabitEthernet1/0/2')]))
+        self.assertEqual(self.switch._task_objects(port),
+                         set([('interfaces', 'GigabitEthernet1/0/1'),
+                              ('vlans', '11'), ('vlans', '12')]))
+
+
+class CheckModeTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    # a switch that fails the test when it opens a session
+    def switch(self, cls=Comware_5_2, **kwargs):
+        switch = cls(host='sw1', check_mode=True, state_dir=self.state_dir,
+                     **kwargs)
+
+        def open_session():
+            self.fail("a session was opened")
+        switch._open_session = open_session
+        return switch
+
+    def test_reboot(self):
+        switch = self.switch()
+        switch.reboot(wait=True)
+        self.assertTrue(switch.get_changed())
+        self.assertTrue("would be rebooted" in switch.get_message())
+
+    def write_snapshot(self, facts):
+        snapshot = open(os.path.join(self.state_dir, 'sw1.facts'), 'w')
+        json.dump(facts_to_dict(facts), snapshot)
+        snapshot.close()
+
+    def test_vlan_from_snapshot(self):
+        self.write_snapshot(
+            {'current_config': ComwareConfig(sample_config).to_dict(),
+             'vlans': {'11': {'Name': 'users',
+                              'Tagged_Ports': ['GigabitEthernet1/0/1'],
+                              'Untagged_Ports': 'none'}}})
+        switch = self.switch(Comware_5_2_Vlan, facts_cache_ttl=60)
+        result = switch.run({'vlan_id': 11, 'vlan_name': 'users',
+                             'tagged_ports': ['GigabitEthernet1/0/1']})
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['commands'], [])
+
+        switch = self.switch(Comware_5_2_Vlan, facts_cache_ttl=60)
+        result = switch.run({'vlan_id': 12, 'vlan_name': 'voice',
+                             'tagged_ports': ['GigabitEthernet1/0/1']})
+        self.assertTrue(result['changed'])
+        self.assertTrue('vlan 12' in result['commands'])
+        self.assertTrue('12' in result['facts']['vlans'])
+
+    def test_port_from_snapshot(self):
+        self.write_snapshot(
+            {'current_config': ComwareConfig(sample_config).to_dict()})
+        switch = self.switch(Comware_5_2_Port, facts_cache_ttl=60)
+        result = switch.run({'name': 'GigabitEthernet1/0/1',
+                             'link_type': 'access', 'vlans': ['11']})
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['commands'],
+                         ['interface GigabitEthernet1/0/1',
+                          'port link-type access', 'port access vlan 11',
+                          'quit'])
+        port = result['facts']['current_config']['interfaces'][
+            'GigabitEthernet1/0/1']
+        self.assertEqual(port['port link-type'], 'access')
+
+
+    def test_save_pending(self):
+        switch = self.switch()
+        pending = open(switch._state_file('pending_save'), 'w')
+        pending.write("Comware_5_2_Vlan: VLAN 10 saved\n")
+        pending.close()
+        self.assertEqual(switch.save_pending(),
+                         ["Comware_5_2_Vlan: VLAN 10 saved"])
+        self.assertTrue(switch.get_changed())
+        # kept for the run that saves
+        self.assertEqual(len(switch.get_pending_save()), 1)
+
+    def test_save_nothing_pending(self):
+        switch = self.switch()
+        self.assertEqual(switch.save_pending(), [])
+        self.assertFalse(switch.get_changed())
+        switch.save_pending(force=True)
+        self.assertTrue(switch.get_changed())
+
+    def test_users_from_snapshot(self):
+        self.write_snapshot(
+            {'current_config': ComwareConfig(sample_config).to_dict()})
+        switch = self.switch(Comware_5_2_User, facts_cache_ttl=60)
+        result = switch.run({'users': [
+            {'user_name': 'bob', 'services': ['telnet']},
+            {'user_name': 'admin', 'state': 'absent'}]})
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['commands'], ['undo local-user admin'])
+        self.assertEqual(result['diff'], {'before': {'admin': {
+            'password': 'cipher secret',
+            'authorization-attribute': 'level 3',
+            'service_type': ['ssh']}}, 'after': {}})
+
+
+    def test_user_int_from_snapshot(self):
+        self.write_snapshot(
+            {'current_config': ComwareConfig(user_int_config).to_dict()})
+        switch = self.switch(Comware_5_2_User_int, facts_cache_ttl=60)
+        result = switch.run({'user_interface_id': range(16),
+                             'user_interface_type': 'vty',
+                             'authentication_mode': 'scheme',
+                             'in_protocol': 'ssh'})
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['commands'],
+                         ['user-interface vty 5 15',
+                          'authentication-mode scheme',
+                          'protocol inbound ssh', 'quit'])
+
+
+    def test_batch_from_snapshot(self):
+        self.write_snapshot(
+            {'current_config': ComwareConfig(sample_config).to_dict(),
+             'vlans': {'11': {'Name': 'users',
+                              'Tagged_Ports': ['GigabitEthernet1/0/1'],
+                              'Untagged_Ports': 'none'}}})
+        port = {'op': 'port', 'name': 'GigabitEthernet1/0/1',
+                'link_type': 'trunk', 'vlans': '1,11-12'}
+        switch = self.switch(Comware_5_2_Batch, facts_cache_ttl=60)
+        result = switch.run({'tasks': [
+            {'op': 'vlan', 'vlan_id': 12, 'vlan_name': 'voice'},
+            port, dict(port)]})
+        self.assertTrue(result['changed'])
+        # the second port task works on the first one's prediction
+        self.assertEqual(result['commands'],
+                         ['vlan 12', 'name voice', 'quit',
+                          'interface GigabitEthernet1/0/1',
+                          'port trunk permit vlan 1 11 to 12', 'quit'])
+        self.assertEqual(len(result['diff']), 2)
+        self.assertTrue('12' in result['facts']['vlans'])
+        port = result['facts']['current_config']['interfaces'][
+            'GigabitEthernet1/0/1']
+        self.assertEqual(VlanSet(port['vlan']['tagged']['trunk']),
+                         VlanSet([1, 11, 12]))
+
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.switch = Comware_5_2(host='sw1', state_dir=self.state_dir,
+                                  breaker_threshold=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def failures(self):
+        return self.switch._load_breaker().get('failures', 0)
+
+    def test_trip_and_reset(self):
+        self.switch._trip_breaker()
+        self.switch._trip_breaker()
+        self.assertEqual(self.failures(), 2)
+        self.switch._reset_breaker()
+        self.assertEqual(self.failures(), 0)
+
+    def test_open_after_threshold(self):
+        mark_unreachable('sw1', 2, self.state_dir)
+        self.switch._probe_ssh = lambda timeout: False
+        self.assertRaises(Comware_5_2_Unreachable,
+                          self.switch._check_breaker)
+        self.assertEqual(self.failures(), 3)
+        # a switch answering its SSH port gets another try
+        self.switch._probe_ssh = lambda timeout: True
+        self.switch._check_breaker()
+
+    def test_window(self):
+        mark_unreachable('sw1', 2, self.state_dir)
+        breaker = self.switch._load_breaker()
+        breaker['failed_at'] -= self.switch.breaker_window + 1
+        json.dump(breaker, open(self.switch._state_file('breaker'), 'w'))
+        self.switch._probe_ssh = lambda timeout: False
+        self.switch._check_breaker()
+        self.switch._trip_breaker()
+        self.assertEqual(self.failures(), 1)
+
+    def test_disabled(self):
+        switch = Comware_5_2(host='sw1', state_dir=self.state_dir,
+                             breaker_threshold=0)
+        switch._trip_breaker()
+        self.assertEqual(self.failures(), 0)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_task_deadline(self):
+        switch = Comware_5_2(host='sw1', task_timeout=60)
+        self.assertTrue(switch._deadline(300) <= time.time() + 60)
+        self.assertTrue(switch._deadline(5) <= time.time() + 5)
+
+    def test_task_time_used_up(self):
+        switch = Comware_5_2(host='sw1', task_timeout=60)
+        switch._task_deadline = time.time() - 1
+        self.assertRaises(Comware_5_2_Timeout, switch._remaining, 30,
+                          "connect")
+        self.assertRaises(Comware_5_2_Timeout, switch._recv,
+                          ScriptChannel(), switch._deadline(30), "the prompt")
+
+    def test_silent_switch(self):
+        switch = Comware_5_2(host='sw1')
+        try:
+            switch._recv(ScriptChannel(), switch._deadline(30), "the prompt")
+        except Comware_5_2_Timeout, e:
+            self.assertEqual(str(e), "timed out waiting for the prompt")
+        else:
+            self.fail("the timeout was not reported")
+
+
+
+class LatencyTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def switch(self, **kwargs):
+        return Comware_5_2(host='sw1', state_dir=self.state_dir,
+                           adaptive_timeouts=True, **kwargs)
+
+    def test_not_adaptive(self):
+        switch = Comware_5_2(host='sw1', state_dir=self.state_dir)
+        switch._record_latency('prompt', 1.0)
+        switch._store_latency()
+        self.assertEqual(switch.get_latency_stats(), {})
+        self.assertEqual(os.listdir(self.state_dir), [])
+
+    def test_learned_timeout(self):
+        switch = self.switch()
+        for latency in [0.1, 0.2, 0.3, 0.4]:
+            switch._record_latency('prompt', latency)
+        self.assertEqual(switch._learned_timeout('prompt', 30), 30)
+        switch._record_latency('prompt', 1.0)
+        self.assertEqual(switch._learned_timeout('prompt', 30), 4.0)
+        self.assertEqual(switch.get_latency_stats()['prompt']['p95'], 1.0)
+
+    def test_learned_timeout_bounds(self):
+        switch = self.switch()
+        for latency in [0.01] * 5:
+            switch._record_latency('prompt', latency)
+        self.assertEqual(switch._learned_timeout('prompt', 30), 2.0)
+        for latency in [100] * 5:
+            switch._record_latency('connect', latency)
+        self.assertEqual(switch._learned_timeout('connect', 30), 120.0)
+
+    def test_learned_display_timeout(self):
+        switch = self.switch(command_timeout=300)
+        self.assertEqual(switch._learned_display_timeout(), 300)
+        for n in range(5):
+            switch._record_latency('display_bytes', 100000)
+            switch._record_latency('display_rate', 10000)
+        self.assertEqual(switch._learned_display_timeout(), 40)
+
+    def test_stored(self):
+        switch = self.switch()
+        for latency in [0.5] * 5:
+            switch._record_latency('prompt', latency)
+        switch._store_latency()
+        switch = self.switch(timeout=30)
+        self.assertEqual(switch._read_timeout, 2.0)
+        self.assertEqual(switch.get_latency_stats()['prompt']['ewma'], 0.5)
+
+    def test_prompts_stored(self):
+        switch = self.switch()
+        switch.channel = ScriptChannel({'vlan %d' % n: "" for n in range(5)})
+        switch._send_commands(["vlan %d\n" % n for n in range(5)])
+        self.assertEqual(
+            len(self.switch()._latency['prompt']['samples']), 5)
+
+
+class PreflightTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    # the server greets one connection with banner
+    def greet(self, banner):
+        def serve():
+            conn, _ = self.server.accept()
+            conn.sendall(banner)
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def test_ssh(self):
+        self.greet("SSH-2.0-Comware-5.20\r\n")
+        self.assertEqual(preflight(['127.0.0.1'], self.port, 5),
+                         {'127.0.0.1': "SSH-2.0-Comware-5.20"})
+
+    def test_not_ssh(self):
+        self.greet("220 ftp ready\r\n")
+        self.assertEqual(preflight(['127.0.0.1'], self.port, 5),
+                         {'127.0.0.1': ''})
+
+    def test_silent(self):
+        self.assertEqual(preflight(['127.0.0.1'], self.port, 0.5),
+                         {'127.0.0.1': ''})
+
+    def test_refused(self):
+        self.server.close()
+        self.assertEqual(preflight(['127.0.0.1', 'localhost'], self.port, 5,
+                                   concurrency=1),
+                         {'127.0.0.1': None, 'localhost': None})
+
+
+@unittest.skipIf(paramiko is None, "needs paramiko")
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.switch = Comware_5_2(host='sw1', state_dir=self.state_dir,
+                                  retries=2)
+        self.switch._backoff = lambda attempt, what: None
+        self.attempts = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    # fails with error the first failures times
+    def attempt(self, failures, error):
+        def attempt():
+            self.attempts += 1
+            if self.attempts <= failures:
+                raise error
+            return self.attempts
+        return attempt
+
+    def test_connect_retried(self):
+        self.switch._connect = self.attempt(2, socket.error("reset"))
+        mark_unreachable('sw1', 1, self.state_dir)
+        self.switch._probe_ssh = lambda timeout: True
+        self.switch._open_session()
+        self.assertEqual(self.attempts, 3)
+        # a session that opened closes the breaker
+        self.assertEqual(self.switch._load_breaker(), {})
+
+    def test_connect_gives_up(self):
+        self.switch._connect = self.attempt(3, socket.error("reset"))
+        self.assertRaises(socket.error, self.switch._open_session)
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(self.switch._load_breaker()['failures'], 1)
+
+    def test_bad_login_not_retried(self):
+        self.switch._connect = self.attempt(
+            1, paramiko.AuthenticationException("denied"))
+        self.assertRaises(paramiko.AuthenticationException,
+                          self.switch._open_session)
+        self.assertEqual(self.attempts, 1)
+
+    def test_read_retried_on_new_session(self):
+        reopened = []
+        self.switch._reopen_session = lambda: reopened.append(True)
+        self.assertEqual(self.switch._retry_read(
+            self.attempt(1, EOFError())), 2)
+        self.assertEqual(reopened, [True])
+        self.assertFalse(self.switch._reading)
+
+    def test_read_error_not_retried(self):
+        self.assertRaises(Comware_5_2_Timeout, self.switch._retry_read,
+                          self.attempt(1, Comware_5_2_Timeout("slow")))
+        self.assertEqual(self.attempts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()